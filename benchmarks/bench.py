@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+
+# Copyright 2023 Quytelda Kahja
+#
+# This file is part of kbundle.
+#
+# kbundle is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kbundle is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with kbundle. If not, see <https://www.gnu.org/licenses/>.
+
+"""Benchmark kbundle operations on a synthetic bundle tree.
+
+A bundle tree with a configurable number of resource files, file size
+distribution and tags per entry is generated in a temporary directory.
+Each phase (scanning, updating, packing, unpacking and manifest I/O)
+is then timed, and the results are printed or written as JSON. Passing
+an earlier result file with --compare reports phases which got slower.
+The in-memory manifest is measured separately with a larger number of
+entries, which don't need files on disk.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import os.path
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+try:
+    import kbundle
+except ImportError:
+    # Allow running the benchmarks from a source checkout.
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src"))
+
+import kbundle.bundle
+import kbundle.cache
+import kbundle.manifest
+
+RESULTS_FORMAT_VERSION = 1
+
+# Generated files are padded with this repeating text, so that they
+# compress roughly as well as real resources.
+FILLER = b"<param name=\"paintop\" type=\"string\"><![CDATA[paintbrush]]></param>\n"
+
+# Generated files get this modification time (2020-01-01), so they
+# look like long-unchanged resources to the checksum cache.
+FILE_MTIME_NS = 1577836800 * 10**9
+
+def parse_size_distribution(spec):
+    """Parse a file size distribution specification.
+
+    Accepted forms are "fixed:SIZE", "uniform:MIN:MAX" and
+    "lognormal:MEDIAN:SIGMA", with sizes in bytes. Returns a function
+    which takes a random.Random and returns a file size.
+    """
+    kind, *params = spec.split(":")
+    try:
+        values = [float(param) for param in params]
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid size distribution: {}".format(spec))
+
+    if kind == "fixed" and len(values) == 1:
+        return lambda rng: int(values[0])
+    if kind == "uniform" and len(values) == 2:
+        return lambda rng: rng.randint(int(values[0]), int(values[1]))
+    if kind == "lognormal" and len(values) == 2:
+        mu = math.log(values[0])
+        return lambda rng: max(1, int(rng.lognormvariate(mu, values[1])))
+
+    raise argparse.ArgumentTypeError("invalid size distribution: {}".format(spec))
+
+def check_size_distribution(spec):
+    """Validate a size distribution specification for argparse."""
+    parse_size_distribution(spec)
+    return spec
+
+def generate_tree(root, files, size_of, compressible, seed):
+    """Create a synthetic bundle tree and return the total resource size."""
+    rng = random.Random(seed)
+    total = 0
+
+    for index in range(files):
+        dirname = kbundle.bundle.RESOURCE_DIR_NAMES[index % len(kbundle.bundle.RESOURCE_DIR_NAMES)]
+        subdir = os.path.join(root, dirname, "set{:02d}".format(index % 16))
+        os.makedirs(subdir, exist_ok=True)
+
+        size = size_of(rng)
+        random_size = int(size * (1 - compressible))
+        data = rng.randbytes(random_size) if hasattr(rng, "randbytes") \
+            else os.urandom(random_size)
+        data += (FILLER * (size // len(FILLER) + 1))[:size - random_size]
+
+        path = os.path.join(subdir, "resource{:06d}.dat".format(index))
+        with open(path, "wb") as file:
+            file.write(data)
+        os.utime(path, ns=(FILE_MTIME_NS, FILE_MTIME_NS))
+        total += size
+
+    with open(os.path.join(root, "meta.xml"), "w") as file:
+        file.write('<?xml version="1.0" encoding="UTF-8"?>\n<meta:meta/>\n')
+    with open(os.path.join(root, "preview.png"), "wb") as file:
+        file.write(rng.randbytes(4096) if hasattr(rng, "randbytes") else os.urandom(4096))
+
+    return total
+
+def reset_tree(root):
+    """Remove everything kbundle creates in a bundle tree."""
+    shutil.rmtree(os.path.join(root, "META-INF"), ignore_errors=True)
+    shutil.rmtree(os.path.join(root, kbundle.cache.CACHE_DIR_NAME), ignore_errors=True)
+
+@contextlib.contextmanager
+def quiet():
+    """Discard anything printed to stdout."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+def timed(results, phase, func, *args, **kwargs):
+    """Call a function, recording its wall and CPU time under `phase`.
+
+    Functions which report failure by returning False abort the
+    benchmark.
+    """
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    with quiet():
+        ok = func(*args, **kwargs)
+    wall = time.perf_counter() - wall
+    cpu = time.process_time() - cpu
+
+    if ok is False:
+        raise RuntimeError("Benchmark phase failed: {}".format(phase))
+
+    results.setdefault(phase, []).append({"wall": wall, "cpu": cpu})
+
+def run_once(root, workdir, args, results):
+    """Run every benchmark phase once on a freshly reset tree."""
+    reset_tree(root)
+    archive_path = os.path.join(workdir, "bench.bundle")
+    unpack_root = os.path.join(workdir, "unpacked")
+    for path in (archive_path, unpack_root):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+    os.mkdir(unpack_root)
+
+    bundle = kbundle.bundle.Bundle(root)
+    timed(results, "scan_files", bundle.scan_files)
+    timed(results, "update_cold", bundle.update_manifest, jobs=args.jobs)
+
+    # Give every entry some tags before measuring manifest I/O.
+    rng = random.Random(args.seed)
+    vocabulary = ["Tag {:03d}".format(n) for n in range(args.tag_vocabulary)]
+    for path in bundle.manifest.entries:
+        for tag in rng.sample(vocabulary, min(args.tags, len(vocabulary))):
+            bundle.manifest.add_tag(path, tag)
+
+    # Manifest.save() returns False when the file is already current.
+    timed(results, "manifest_save", lambda: bundle.manifest.save() or None)
+    timed(results, "manifest_save_unchanged", lambda: bundle.manifest.save() or None)
+    timed(results, "manifest_load", bundle.manifest.load)
+
+    bundle = kbundle.bundle.Bundle(root)
+    bundle.load()
+    timed(results, "update_warm", bundle.update_manifest, jobs=args.jobs)
+    timed(results, "pack", bundle.pack, archive_path, jobs=args.jobs)
+    timed(results, "pack_incremental", bundle.pack, archive_path,
+          base_path=archive_path, jobs=args.jobs)
+
+    unpacked = kbundle.bundle.Bundle(unpack_root)
+    timed(results, "unpack", unpacked.unpack, archive_path, jobs=args.jobs)
+    timed(results, "unpack_incremental", unpacked.unpack, archive_path,
+          jobs=args.jobs, incremental=True)
+
+def manifest_paths(count):
+    """Generate internal paths for a large synthetic manifest."""
+    media_types = kbundle.bundle.RESOURCE_DIR_NAMES
+    return [os.path.join(media_types[n % len(media_types)], "sub{:03d}".format(n // 1000),
+                         "res{:07d}.dat".format(n))
+            for n in range(count)]
+
+def fill_manifest(manifest, paths, vocabulary, tags, seed):
+    """Insert an entry for each path, then tag each entry.
+
+    Media types and tags are passed as distinct string objects, as
+    they would be after parsing a manifest file.
+    """
+    for path in paths:
+        manifest.insert_entry(kbundle.manifest.ManifestEntry(
+            full_path  = path,
+            media_type = path.split(os.sep, 1)[0],
+            md5sum     = "{:032x}".format(hash(path) & (2**128 - 1)),
+            tags       = []))
+
+    rng = random.Random(seed)
+    for path in paths:
+        for tag in rng.sample(vocabulary, min(tags, len(vocabulary))):
+            manifest.add_tag(path, tag.encode().decode())
+
+def run_manifest(args, results, memory):
+    """Measure building and updating a large manifest in memory."""
+    paths = manifest_paths(args.manifest_entries)
+    vocabulary = ["Tag {:03d}".format(n) for n in range(args.tag_vocabulary)]
+
+    # Measuring allocations slows everything down, so it is done
+    # separately from the timed phases.
+    tracemalloc.start()
+    manifest = kbundle.manifest.Manifest(os.devnull)
+    fill_manifest(manifest, paths, vocabulary, args.tags, args.seed)
+    memory["manifest_bytes"] = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del manifest
+
+    manifest = kbundle.manifest.Manifest(os.devnull)
+    timed(results, "manifest_build", fill_manifest, manifest, paths, vocabulary,
+          args.tags, args.seed)
+
+    # Replacing every entry merges the old tags into the new entries,
+    # as updating the manifest does for changed resources.
+    def merge():
+        for path in paths:
+            entry = manifest.entries[path]
+            manifest.insert_entry(kbundle.manifest.ManifestEntry(
+                full_path  = path,
+                media_type = entry.media_type,
+                md5sum     = entry.md5sum,
+                tags       = [vocabulary[0]]))
+
+    timed(results, "manifest_merge", merge)
+
+    def retag():
+        for path in paths:
+            manifest.remove_tag(path, vocabulary[0])
+            manifest.add_tag(path, vocabulary[0])
+
+    timed(results, "manifest_retag", retag)
+
+def summarize(results):
+    """Reduce the raw timings of each phase to summary statistics."""
+    summary = {}
+    for phase, runs in results.items():
+        walls = [run["wall"] for run in runs]
+        cpus = [run["cpu"] for run in runs]
+        summary[phase] = {"wall_min"   : min(walls),
+                          "wall_median": statistics.median(walls),
+                          "cpu_median" : statistics.median(cpus),
+                          "runs"       : runs}
+
+    return summary
+
+def compare(current, baseline, threshold):
+    """Print a comparison with earlier results, returning False on regressions."""
+    ok = True
+    print("{:<26} {:>10} {:>10} {:>8}".format("phase", "baseline", "current", "change"))
+    for phase, stats in current["results"].items():
+        old = baseline.get("results", {}).get(phase)
+        if old is None:
+            print("{:<26} {:>10} {:>10.4f} {:>8}".format(phase, "-", stats["wall_min"], "new"))
+            continue
+
+        change = stats["wall_min"] / old["wall_min"] - 1 if old["wall_min"] else 0.0
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            ok = False
+
+        print("{:<26} {:>10.4f} {:>10.4f} {:>+7.1%}{}".format(phase, old["wall_min"],
+                                                             stats["wall_min"], change, flag))
+
+    if baseline.get("params") != current["params"]:
+        print("Warning: the benchmark parameters differ from the baseline.", file=sys.stderr)
+
+    return ok
+
+def get_argument_parser():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-n", "--files", type=int, default=1000,
+                        help="number of resource files to generate (default: 1000)")
+    parser.add_argument("--size-dist", type=check_size_distribution,
+                        default="lognormal:16384:1.0", metavar="SPEC",
+                        help="file size distribution: fixed:SIZE, uniform:MIN:MAX or "
+                             "lognormal:MEDIAN:SIGMA (default: lognormal:16384:1.0)")
+    parser.add_argument("--compressible", type=float, default=0.5, metavar="FRACTION",
+                        help="fraction of each file filled with compressible text (default: 0.5)")
+    parser.add_argument("--tags", type=int, default=2,
+                        help="number of tags per manifest entry (default: 2)")
+    parser.add_argument("--tag-vocabulary", type=int, default=50, metavar="N",
+                        help="number of distinct tags (default: 50)")
+    parser.add_argument("--manifest-entries", type=int, default=100000, metavar="N",
+                        help="number of entries in the in-memory manifest benchmark, "
+                             "or 0 to skip it (default: 100000)")
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+                        help="number of times to run each phase (default: 3)")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="worker threads for hashing and compression")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="random seed for the generated tree (default: 0)")
+    parser.add_argument("--workdir", metavar="DIR",
+                        help="generate files here instead of a temporary directory")
+    parser.add_argument("-o", "--output", metavar="FILE",
+                        help="write results as JSON to FILE ('-' for stdout)")
+    parser.add_argument("--compare", metavar="FILE",
+                        help="compare with results from an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="relative slowdown reported as a regression (default: 0.10)")
+    return parser
+
+def main():
+    parser = get_argument_parser()
+    args = parser.parse_args()
+
+    with contextlib.ExitStack() as stack:
+        workdir = args.workdir or stack.enter_context(tempfile.TemporaryDirectory(prefix="kbundle-bench-"))
+        root = os.path.join(workdir, "tree")
+        if os.path.isdir(root):
+            shutil.rmtree(root)
+
+        print("Generating {} files in {}...".format(args.files, root), file=sys.stderr)
+        total_size = generate_tree(root, args.files,
+                                   parse_size_distribution(args.size_dist),
+                                   args.compressible, args.seed)
+
+        results = {}
+        memory = {}
+        for run in range(args.repeat):
+            print("Run {}/{}...".format(run + 1, args.repeat), file=sys.stderr)
+            run_once(root, workdir, args, results)
+
+        if args.manifest_entries:
+            print("Measuring a manifest with {} entries...".format(args.manifest_entries),
+                  file=sys.stderr)
+            for run in range(args.repeat):
+                run_manifest(args, results, memory)
+
+    current = {
+        "format"     : RESULTS_FORMAT_VERSION,
+        "params"     : {"files"       : args.files,
+                        "size_dist"   : args.size_dist,
+                        "compressible": args.compressible,
+                        "tags"        : args.tags,
+                        "manifest_entries": args.manifest_entries,
+                        "jobs"        : args.jobs,
+                        "seed"        : args.seed,
+                        "total_bytes" : total_size},
+        "environment": {"python"   : platform.python_version(),
+                        "platform" : platform.platform(),
+                        "cpu_count": os.cpu_count()},
+        "results"    : summarize(results),
+        "memory"     : memory,
+    }
+
+    if args.output == "-":
+        json.dump(current, sys.stdout, indent=2)
+        print()
+    elif args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(current, output_file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        return 0 if compare(current, baseline, args.threshold) else 1
+
+    if args.output != "-":
+        for phase, stats in current["results"].items():
+            print("{:<26} {:>10.4f}s  (cpu {:.4f}s)".format(phase, stats["wall_min"], stats["cpu_median"]))
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
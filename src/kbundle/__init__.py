@@ -17,57 +17,407 @@
 # You should have received a copy of the GNU General Public License
 # along with kbundle. If not, see <https://www.gnu.org/licenses/>.
 
+import kbundle.archive
+import kbundle.build
 import kbundle.bundle
+import kbundle.cache
+import kbundle.compression
+import kbundle.diff
+import kbundle.stats
+import kbundle.verify
+import kbundle.watch
+import logging
+import glob
 import sys
 import os
 import argparse
+import cProfile
+
+logger = logging.getLogger(__name__)
 
 def unpack(bundle, args):
-    return bundle.unpack(args.path)
+    return bundle.unpack(args.path,
+                         jobs=args.jobs,
+                         incremental=args.incremental,
+                         patterns=args.member,
+                         media_types=args.type)
 
 def pack(bundle, args):
-    return bundle.pack(args.path)
+    archive = args.path
+    if archive == "-":
+        # Keep messages out of the archive data.
+        configure_logging(sys.stderr)
+        archive = sys.stdout.buffer
+
+    base_path = args.base
+    if args.incremental and base_path is None and os.path.isfile(args.path):
+        base_path = args.path
+
+    blob_cache = None
+    if args.blob_cache:
+        blob_cache = kbundle.cache.BlobCache(args.blob_cache_dir, args.blob_cache_size)
+
+    policy = kbundle.compression.CompressionPolicy(args.compress)
+
+    date_time = None
+    if args.reproducible:
+        try:
+            date_time = kbundle.archive.reproducible_date_time()
+        except ValueError as e:
+            logger.error(e)
+            return False
+
+    return bundle.pack(archive, base_path=base_path, jobs=args.jobs,
+                       blob_cache=blob_cache, policy=policy,
+                       date_time=date_time, force=args.force, update=args.update)
 
 def update(bundle, args):
-    return bundle.update_manifest()
+    if args.paths:
+        return bundle.update_paths(args.paths, jobs=args.jobs, use_cache=args.use_cache)
+
+    if not bundle.scan_files():
+        logger.error("Failed to scan bundle directory.")
+        return False
+
+    return bundle.update_manifest(use_cache=args.use_cache, jobs=args.jobs)
+
+def watch_changes(bundle, args):
+    return kbundle.watch.watch(bundle,
+                               archive_path=args.pack,
+                               debounce=args.debounce,
+                               poll=args.poll,
+                               interval=args.interval,
+                               jobs=args.jobs)
+
+def build_all(bundle, args):
+    try:
+        targets = [kbundle.build.parse_build_target(spec) for spec in args.targets]
+        if args.config:
+            targets += kbundle.build.parse_build_config(args.config)
+    except (OSError, ValueError) as e:
+        logger.error(e)
+        return False
+
+    if not targets:
+        logger.error("No bundles to build.")
+        return False
+
+    blob_cache_settings = None
+    if args.blob_cache:
+        blob_cache_settings = {"path": args.blob_cache_dir, "max_size": args.blob_cache_size}
+
+    date_time = None
+    if args.reproducible:
+        try:
+            date_time = kbundle.archive.reproducible_date_time()
+        except ValueError as e:
+            logger.error(e)
+            return False
+
+    return kbundle.build.build_all(targets,
+                                   processes=args.processes,
+                                   incremental=not args.full,
+                                   jobs=args.jobs,
+                                   verbose=args.verbose,
+                                   blob_cache_settings=blob_cache_settings,
+                                   compression_rules=args.compress,
+                                   date_time=date_time)
+
+def verify_archives(bundle, args):
+    return kbundle.verify.verify_archives(args.paths, jobs=args.jobs, quiet=args.quiet)
+
+def diff_bundles(bundle, args):
+    return kbundle.diff.print_diff(args.old, args.new, output_format=args.format, jobs=args.jobs)
 
 def list(bundle, args):
     return bundle.print_manifest_entries()
 
+def query(bundle, args):
+    return bundle.print_query(tags=args.tag,
+                              media_type=args.type,
+                              prefix=args.prefix,
+                              untagged=args.untagged,
+                              output_format=args.format)
+
 def tag_add(bundle, args):
-    return bundle.add_tag(args.path, args.tag)
+    if len(args.path) == 1 and not glob.has_magic(args.path[0]):
+        return bundle.add_tag(args.path[0], args.tag)
+
+    return bundle.apply_tag_operations(("add", args.tag, path) for path in args.path)
 
 def tag_del(bundle, args):
-    return bundle.remove_tag(args.path, args.tag)
+    if len(args.path) == 1 and not glob.has_magic(args.path[0]):
+        return bundle.remove_tag(args.path[0], args.tag)
+
+    return bundle.apply_tag_operations(("remove", args.tag, path) for path in args.path)
+
+def tag_apply(bundle, args):
+    try:
+        if args.file == "-":
+            operations = [*kbundle.bundle.parse_tag_operations(sys.stdin)]
+        else:
+            with open(args.file, "r", encoding="utf-8") as ops_file:
+                operations = [*kbundle.bundle.parse_tag_operations(ops_file)]
+    except (OSError, ValueError) as e:
+        logger.error(e)
+        return False
+
+    return bundle.apply_tag_operations(operations)
 
 def tag_ls(bundle, args):
     return bundle.print_tags(args.path)
 
+def preset_ls(bundle, args):
+    return bundle.print_presets(paintop=args.paintop,
+                                name=args.name,
+                                resource=args.resource,
+                                output_format=args.format,
+                                jobs=args.jobs)
+
+def preset_rename(bundle, args):
+    return bundle.rename_presets(args.path, name=args.name, jobs=args.jobs)
+
+def positive_int(value):
+    """Parse a strictly positive integer command line argument."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be a positive integer: {}".format(value))
+
+    return number
+
+def size(value):
+    """Parse a size in bytes command line argument, such as '512M'."""
+    try:
+        return kbundle.cache.parse_size(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid size: {}".format(value))
+
+def compression_rule(value):
+    """Check a compression rule command line argument, such as '.kpp=store'."""
+    try:
+        kbundle.compression.parse_compression_rule(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+    return value
+
+def add_compression_arguments(parser):
+    """Add options controlling how archive members are compressed."""
+    parser.add_argument("--compress",
+                        type=compression_rule,
+                        action="append",
+                        default=[],
+                        metavar="SELECTOR=METHOD",
+                        help="compress files matching SELECTOR (an extension such as '.kpp', "
+                             "a size such as '<4K', a media type or '*') with METHOD "
+                             "('store', 'deflate[:LEVEL]' or 'auto[:LEVEL]'); may be repeated")
+
+def add_reproducible_arguments(parser):
+    """Add the option for building reproducible bundle archives."""
+    parser.add_argument("--reproducible",
+                        action="store_true",
+                        default=bool(os.environ.get("SOURCE_DATE_EPOCH")),
+                        help="give every member the same timestamp (from $SOURCE_DATE_EPOCH, "
+                             "or 1980-01-01) and permissions, and skip packing when the "
+                             "output is already up to date (default if $SOURCE_DATE_EPOCH is set)")
+
+def add_blob_cache_arguments(parser):
+    """Add options controlling the shared compressed data cache."""
+    parser.add_argument("--blob-cache",
+                        action="store_true",
+                        help="reuse and store compressed data in a cache shared by all bundles, "
+                             "which may use up to --blob-cache-size of disk space")
+    parser.add_argument("--blob-cache-dir",
+                        metavar="DIR",
+                        help="location of the shared compressed data cache "
+                             "(default: $XDG_CACHE_HOME/kbundle/blobs)")
+    parser.add_argument("--blob-cache-size",
+                        type=size,
+                        default=kbundle.cache.DEFAULT_BLOB_CACHE_SIZE,
+                        metavar="SIZE",
+                        help="maximum size of the shared compressed data cache (default: 1G)")
+
 def get_argument_parser():
     parser = argparse.ArgumentParser()
-    parser.set_defaults(load=True)
+    parser.set_defaults(load=True, scan=True)
     parser.add_argument("-r", "--root",
                         default=os.curdir,
                         metavar="DIR",
                         help="the root directory of a bundle tree")
+    parser.add_argument("--stats",
+                        action="store_true",
+                        help="print time spent in each phase and I/O counters when done")
+    parser.add_argument("--stats-file",
+                        metavar="FILE",
+                        help="write time spent in each phase and I/O counters to FILE as JSON")
+    parser.add_argument("--profile",
+                        metavar="FILE",
+                        help="profile the command and write pstats data to FILE")
 
     subparsers = parser.add_subparsers(required=True)
 
     parser_update = subparsers.add_parser("update", help="rebuild the bundle manifest")
-    parser_update.set_defaults(func=update)
+    parser_update.set_defaults(func=update, scan=False)
+    parser_update.add_argument("paths",
+                               nargs="*",
+                               metavar="PATH",
+                               help="only update the entries for these files or directories")
+    parser_update.add_argument("--no-cache",
+                               dest="use_cache",
+                               action="store_false",
+                               help="rehash every resource instead of reusing cached checksums")
+    parser_update.add_argument("-j", "--jobs",
+                               type=positive_int,
+                               metavar="N",
+                               help="number of files to hash in parallel")
+
+    parser_watch = subparsers.add_parser("watch", help="keep the manifest up to date as resources change")
+    parser_watch.set_defaults(func=watch_changes)
+    parser_watch.add_argument("--pack",
+                              metavar="FILE",
+                              help="also repack this bundle file after each update")
+    parser_watch.add_argument("--debounce",
+                              type=float,
+                              default=0.3,
+                              metavar="SEC",
+                              help="wait until no changes happen for this long before updating")
+    parser_watch.add_argument("--poll",
+                              action="store_true",
+                              help="poll for changes instead of using inotify")
+    parser_watch.add_argument("--interval",
+                              type=float,
+                              default=0.5,
+                              metavar="SEC",
+                              help="time between polls when polling for changes")
+    parser_watch.add_argument("-j", "--jobs",
+                              type=positive_int,
+                              metavar="N",
+                              help="number of files to hash or compress in parallel")
 
     parser_list = subparsers.add_parser("list", help="list all entries in the manifest")
     parser_list.set_defaults(func=list)
 
     parser_pack = subparsers.add_parser("pack", help="zip a bundle tree into a bundle archive")
     parser_pack.set_defaults(func=pack)
-    parser_pack.add_argument("path", help="output bundle file")
+    parser_pack.add_argument("path", help="output bundle file ('-' for standard output)")
+    parser_pack.add_argument("--base",
+                             metavar="FILE",
+                             help="copy unchanged members from a previously built bundle file")
+    parser_pack.add_argument("-i", "--incremental",
+                             action="store_true",
+                             help="use the existing output bundle file as the base, if there is one")
+    parser_pack.add_argument("-j", "--jobs",
+                             type=positive_int,
+                             metavar="N",
+                             help="number of files to compress in parallel")
+    parser_pack.add_argument("-u", "--update",
+                             action="store_true",
+                             help="update the manifest while packing, reading each changed "
+                                  "resource only once")
+    parser_pack.add_argument("-f", "--force",
+                             action="store_true",
+                             help="repack a reproducible bundle even if it is up to date")
+    add_compression_arguments(parser_pack)
+    add_reproducible_arguments(parser_pack)
+    add_blob_cache_arguments(parser_pack)
+
+    parser_verify = subparsers.add_parser("verify", help="check bundle files against their manifests")
+    parser_verify.set_defaults(func=verify_archives, load=False)
+    parser_verify.add_argument("paths", nargs="+", metavar="FILE", help="bundle files to check")
+    parser_verify.add_argument("-j", "--jobs",
+                               type=positive_int,
+                               metavar="N",
+                               help="number of members to check in parallel")
+    parser_verify.add_argument("-q", "--quiet",
+                               action="store_true",
+                               help="only report bundle files with problems")
+
+    parser_diff = subparsers.add_parser("diff", help="list resources changed between two bundles")
+    parser_diff.set_defaults(func=diff_bundles, load=False)
+    parser_diff.add_argument("old", help="old bundle file or bundle tree")
+    parser_diff.add_argument("new", help="new bundle file or bundle tree")
+    parser_diff.add_argument("--format",
+                             choices=["text", "json"],
+                             default="text",
+                             help="print one tab-separated line per change, or a JSON object")
+    parser_diff.add_argument("-j", "--jobs",
+                             type=positive_int,
+                             metavar="N",
+                             help="number of files to hash in parallel")
+
+    parser_build_all = subparsers.add_parser("build-all", help="update and pack many bundles in parallel")
+    parser_build_all.set_defaults(func=build_all, load=False)
+    parser_build_all.add_argument("targets",
+                                  nargs="*",
+                                  metavar="ROOT:OUTPUT",
+                                  help="a bundle root directory and the bundle file to build from it")
+    parser_build_all.add_argument("-c", "--config",
+                                  metavar="FILE",
+                                  help="file listing a bundle root and output file on each line")
+    parser_build_all.add_argument("-p", "--processes",
+                                  type=positive_int,
+                                  metavar="N",
+                                  help="number of bundles to build at once (default: one per CPU)")
+    parser_build_all.add_argument("-j", "--jobs",
+                                  type=positive_int,
+                                  default=1,
+                                  metavar="N",
+                                  help="worker threads used within each bundle (default: 1)")
+    parser_build_all.add_argument("--full",
+                                  action="store_true",
+                                  help="recompress everything instead of repacking incrementally")
+    parser_build_all.add_argument("-v", "--verbose",
+                                  action="store_true",
+                                  help="show the output of successful builds too")
+    add_compression_arguments(parser_build_all)
+    add_reproducible_arguments(parser_build_all)
+    add_blob_cache_arguments(parser_build_all)
 
     parser_unpack = subparsers.add_parser("unpack", help="unzip a bundle archive into a bundle tree")
     parser_unpack.set_defaults(func=unpack, load=False)
     parser_unpack.add_argument("path", help="input bundle file")
+    parser_unpack.add_argument("-i", "--incremental",
+                               action="store_true",
+                               help="only extract files which are missing or differ from the "
+                                    "bundle file, leaving unchanged files untouched")
+    parser_unpack.add_argument("-m", "--member",
+                               action="append",
+                               default=[],
+                               metavar="PATTERN",
+                               help="only extract members whose names match this glob pattern "
+                                    "(may be repeated)")
+    parser_unpack.add_argument("--type",
+                               action="append",
+                               default=[],
+                               metavar="MEDIA_TYPE",
+                               help="only extract resources of this media type (may be repeated)")
+    parser_unpack.add_argument("-j", "--jobs",
+                               type=positive_int,
+                               metavar="N",
+                               help="number of files to extract in parallel")
+
+    parser_query = subparsers.add_parser("query", help="find manifest entries by tag, media type or path")
+    parser_query.set_defaults(func=query, scan=False)
+    parser_query.add_argument("-t", "--tag",
+                              action="append",
+                              default=[],
+                              help="only entries with this tag (may be repeated)")
+    parser_query.add_argument("--type",
+                              metavar="MEDIA_TYPE",
+                              help="only entries with this media type, e.g. 'palettes'")
+    parser_query.add_argument("--prefix",
+                              metavar="PATH",
+                              help="only entries in this directory")
+    parser_query.add_argument("--untagged",
+                              action="store_true",
+                              help="only entries without any tags")
+    parser_query.add_argument("--format",
+                              choices=["paths", "json"],
+                              default="paths",
+                              help="print paths, or one JSON object per entry")
 
     parser_tag = subparsers.add_parser("tag", help="inspect or modify resource tags")
+    parser_tag.set_defaults(scan=False)
     subparsers_tag = parser_tag.add_subparsers(required=True)
 
     parser_tag_ls = subparsers_tag.add_parser("ls", help="list tags")
@@ -77,15 +427,67 @@ def get_argument_parser():
     parser_tag_add = subparsers_tag.add_parser("add", help="add a tag")
     parser_tag_add.set_defaults(func=tag_add)
     parser_tag_add.add_argument("tag", help="tag to add")
-    parser_tag_add.add_argument("path", help="resource file to tag")
+    parser_tag_add.add_argument("path", nargs="+", help="resource files or glob patterns to tag")
 
     parser_tag_remove = subparsers_tag.add_parser("remove", help="remove a tag")
     parser_tag_remove.set_defaults(func=tag_del)
     parser_tag_remove.add_argument("tag", help="tag to remove")
-    parser_tag_remove.add_argument("path", help="resource file to untag")
+    parser_tag_remove.add_argument("path", nargs="+", help="resource files or glob patterns to untag")
+
+    parser_tag_apply = subparsers_tag.add_parser("apply", help="add and remove tags listed in a file")
+    parser_tag_apply.set_defaults(func=tag_apply)
+    parser_tag_apply.add_argument("file",
+                                  nargs="?",
+                                  default="-",
+                                  help="file with one tab-separated 'add|remove TAG PATH' per line (default: stdin)")
+
+    parser_preset = subparsers.add_parser("preset", help="inspect or modify paintop presets")
+    subparsers_preset = parser_preset.add_subparsers(required=True)
+
+    parser_preset_ls = subparsers_preset.add_parser("ls", help="list preset names and paintops")
+    parser_preset_ls.set_defaults(func=preset_ls, scan=False)
+    parser_preset_ls.add_argument("--paintop",
+                                  metavar="ID",
+                                  help="only presets for this paintop, e.g. 'paintbrush'")
+    parser_preset_ls.add_argument("--name",
+                                  metavar="PATTERN",
+                                  help="only presets whose name matches this glob pattern")
+    parser_preset_ls.add_argument("--resource",
+                                  metavar="FILENAME",
+                                  help="only presets using the resource with this file name")
+    parser_preset_ls.add_argument("--format",
+                                  choices=["table", "json"],
+                                  default="table",
+                                  help="print tab-separated path, name and paintop, or one JSON object per preset")
+    parser_preset_ls.add_argument("-j", "--jobs",
+                                  type=positive_int,
+                                  metavar="N",
+                                  help="number of presets to read in parallel")
+
+    parser_preset_rename = subparsers_preset.add_parser("rename", help="change the names stored in presets")
+    parser_preset_rename.set_defaults(func=preset_rename, scan=False)
+    parser_preset_rename.add_argument("path", nargs="+", help="preset files or directories of presets")
+    parser_preset_rename.add_argument("-n", "--name",
+                                      help="new name for a single preset (default: derived from the file name)")
+    parser_preset_rename.add_argument("-j", "--jobs",
+                                      type=positive_int,
+                                      metavar="N",
+                                      help="number of presets to rewrite in parallel")
 
     return parser
 
+def configure_logging(info_stream=None):
+    """Print informational messages to stdout (or `info_stream`), and
+    warnings and errors to stderr."""
+    info_handler = logging.StreamHandler(info_stream or sys.stdout)
+    info_handler.addFilter(lambda record: record.levelno < logging.WARNING)
+    error_handler = logging.StreamHandler(sys.stderr)
+    error_handler.setLevel(logging.WARNING)
+
+    logger.handlers = [info_handler, error_handler]
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+
 def main():
     """The primary program entrypoint.
 
@@ -93,11 +495,34 @@ def main():
     and exit reporting status.
     """
     args = get_argument_parser().parse_args()
+    configure_logging()
+
+    profiler = None
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    try:
+        with kbundle.stats.phase("total"):
+            status = run(args)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+
+        if args.stats:
+            print(kbundle.stats.STATS.to_string(), file=sys.stderr)
+        if args.stats_file:
+            kbundle.stats.STATS.save(args.stats_file)
+
+    exit(status)
 
+def run(args):
+    """Load the bundle and run the selected command, returning an exit status."""
     bundle = kbundle.bundle.Bundle(args.root)
-    if args.load and not bundle.load():
-        print("Failed to load bundle.", file=sys.stderr)
+    if args.load and not bundle.load(scan=args.scan):
+        logger.error("Failed to load bundle.")
         return 2
 
     ok = args.func(bundle, args)
-    exit(0 if ok else 3)
+    return 0 if ok else 3
@@ -0,0 +1,122 @@
+# Copyright 2023 Quytelda Kahja
+#
+# This file is part of kbundle.
+#
+# kbundle is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kbundle is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with kbundle. If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import functools
+import io
+
+# Archive data is handed to the event loop in pieces of about this
+# many bytes.
+STREAM_CHUNK_SIZE = 64 * 1024
+
+async def run_blocking(func, *args, executor=None, **kwargs):
+    """Run a blocking function in an executor and wait for its result.
+
+    If no executor is given, the event loop's default thread pool is
+    used. The Bundle methods wrapped below may use worker threads of
+    their own, so they aren't meant for process pools.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+async def load(bundle, scan=True, executor=None):
+    """See Bundle.load()."""
+    return await run_blocking(bundle.load, scan, executor=executor)
+
+async def update_manifest(bundle, use_cache=True, jobs=None, executor=None):
+    """See Bundle.update_manifest()."""
+    return await run_blocking(bundle.update_manifest, use_cache, jobs, executor=executor)
+
+async def update_entries(bundle, ipaths, jobs=None, executor=None):
+    """See Bundle.update_entries()."""
+    return await run_blocking(bundle.update_entries, ipaths, jobs, executor=executor)
+
+async def pack(bundle, archive, executor=None, **kwargs):
+    """See Bundle.pack(). `archive` may be a path or a binary file object."""
+    return await run_blocking(bundle.pack, archive, executor=executor, **kwargs)
+
+async def unpack(bundle, archive_path, executor=None, **kwargs):
+    """See Bundle.unpack()."""
+    return await run_blocking(bundle.unpack, archive_path, executor=executor, **kwargs)
+
+class QueueWriter(io.RawIOBase):
+    """A non-seekable binary stream which passes written data to an asyncio.Queue.
+
+    It is written to from a worker thread. Each write waits until the
+    queue has room, so a slow consumer holds back the producer instead
+    of letting data pile up in memory.
+    """
+
+    def __init__(self, queue, loop):
+        self.queue = queue
+        self.loop = loop
+        self.cancelled = False
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.cancelled:
+            raise OSError("The archive stream was closed by the reader")
+
+        data = bytes(data)
+        asyncio.run_coroutine_threadsafe(self.queue.put(data), self.loop).result()
+        return len(data)
+
+async def iter_pack(bundle, executor=None, max_chunks=16, **kwargs):
+    """Pack a bundle, yielding the archive data as it is produced.
+
+    This is meant for sending a bundle over the network while it is
+    being built: the first bytes are available as soon as the first
+    members have been compressed. At most `max_chunks` pieces of data
+    are buffered. Other keyword arguments are passed to Bundle.pack().
+    Raises OSError if packing fails. If the consumer stops early, the
+    packing is aborted.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=max_chunks)
+    writer = QueueWriter(queue, loop)
+
+    def produce():
+        try:
+            with io.BufferedWriter(writer, buffer_size=STREAM_CHUNK_SIZE) as stream:
+                return bundle.pack(stream, **kwargs)
+        finally:
+            if not writer.cancelled:
+                asyncio.run_coroutine_threadsafe(queue.put(None), loop).result()
+
+    future = loop.run_in_executor(executor, produce)
+    try:
+        while True:
+            chunk = await queue.get()
+            if chunk is None:
+                break
+            yield chunk
+    finally:
+        # Unblock and stop the producer if the consumer gave up early.
+        writer.cancelled = True
+        while not future.done():
+            try:
+                queue.get_nowait()
+            except asyncio.QueueEmpty:
+                await asyncio.sleep(0.01)
+
+        if not future.cancelled():
+            future.exception()
+
+    if not await future:
+        raise OSError("Failed to pack bundle")
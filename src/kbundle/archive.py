@@ -0,0 +1,416 @@
+# Copyright 2023 Quytelda Kahja
+#
+# This file is part of kbundle.
+#
+# kbundle is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kbundle is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with kbundle. If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import os
+import os.path
+import stat
+import struct
+import time
+import zipfile as Zip
+import zlib
+
+import kbundle.manifest
+import kbundle.stats
+
+logger = logging.getLogger(__name__)
+
+# Compressed member data is copied in chunks of this many bytes.
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# The fixed-size part of a ZIP local file header, which is followed by
+# the file name and the extra field.
+LOCAL_HEADER = struct.Struct("<4s2B4HL2L2H")
+LOCAL_HEADER_SIGNATURE = b"PK\003\004"
+LOCAL_HEADER_NAME_LENGTH  = 10
+LOCAL_HEADER_EXTRA_LENGTH = 11
+
+# Members using these compression methods can be copied between archives.
+RAW_COPY_METHODS = (Zip.ZIP_STORED, Zip.ZIP_DEFLATED)
+
+# In reproducible archives, every member has the same timestamp and
+# these permissions.
+REPRODUCIBLE_MODE = stat.S_IFREG | 0o644
+
+# ZIP timestamps can't represent times before 1980 or after 2107.
+ZIP_MIN_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+ZIP_MAX_DATE_TIME = (2107, 12, 31, 23, 59, 58)
+
+# Reproducible archives record a fingerprint of their inputs in the
+# archive comment, following this prefix.
+FINGERPRINT_PREFIX = b"kbundle-fingerprint: "
+
+def crc32sum(path):
+    """Return the CRC-32 checksum of the file at the provided path."""
+    crc = 0
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(COPY_CHUNK_SIZE), b''):
+            crc = zlib.crc32(chunk, crc)
+            kbundle.stats.count("bytes_read", len(chunk))
+
+    return crc
+
+def file_info(ipath, st):
+    """Describe a file as an archive member, using its stat result
+    instead of calling stat() again like ZipInfo.from_file().
+
+    Modification times which ZIP can't represent are clamped.
+    """
+    date_time = tuple(time.localtime(st.st_mtime)[:6])
+    info = Zip.ZipInfo(archive_name(ipath),
+                       date_time=min(max(date_time, ZIP_MIN_DATE_TIME), ZIP_MAX_DATE_TIME))
+    info.external_attr = (st.st_mode & 0xFFFF) << 16
+    info.file_size = st.st_size
+
+    return info
+
+def compress_member(xpath, ipath, st, compress_type=Zip.ZIP_DEFLATED,
+                    level=zlib.Z_DEFAULT_COMPRESSION, hash_alg=None, choose=None):
+    """Read and compress a file for inclusion in an archive.
+
+    The file is read in chunks and compressed with zlib directly,
+    the same way ZipFile.write() does, so this can be run by several
+    threads at once. `st` is the stat result of the file, which
+    provides the member's timestamp and permissions. If a hashlib
+    object is given as `hash_alg`, it is updated with each chunk as
+    well, so the file only has to be read once to checksum and
+    compress it. If `choose` is given, it is called with the first
+    chunk and returns the compression type and level to use instead
+    of `compress_type` and `level`, so the file can be sampled
+    without reading it again. Returns a ZipInfo describing the member
+    and a list of compressed data chunks, to be passed on to
+    write_raw_member(). Raises ValueError for compression methods
+    other than ZIP_STORED and ZIP_DEFLATED.
+    """
+    info = file_info(ipath, st)
+
+    crc = 0
+    file_size = 0
+    chunks = []
+    with open(xpath, "rb") as file:
+        chunk = file.read(COPY_CHUNK_SIZE)
+        if choose is not None:
+            compress_type, level = choose(chunk)
+
+        compressor = None
+        if compress_type == Zip.ZIP_DEFLATED:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        elif compress_type != Zip.ZIP_STORED:
+            raise ValueError("Unsupported compression method: {}".format(compress_type))
+
+        while chunk:
+            crc = zlib.crc32(chunk, crc)
+            file_size += len(chunk)
+            if hash_alg is not None:
+                hash_alg.update(chunk)
+
+            data = chunk if compressor is None else compressor.compress(chunk)
+            if data:
+                chunks.append(data)
+
+            chunk = file.read(COPY_CHUNK_SIZE)
+
+    if compressor is not None:
+        chunks.append(compressor.flush())
+
+    info.compress_type = compress_type
+    info.CRC = crc
+    info.file_size = file_size
+    info.compress_size = sum(map(len, chunks))
+
+    kbundle.stats.count("bytes_read", file_size)
+    if hash_alg is not None:
+        kbundle.stats.count("bytes_hashed", file_size)
+        kbundle.stats.count("files_hashed")
+    kbundle.stats.count("bytes_compressed_in", file_size)
+    kbundle.stats.count("bytes_compressed_out", info.compress_size)
+
+    return info, chunks
+
+def archive_name(ipath):
+    """Convert an internal path into the name of an archive member."""
+    return ipath.replace(os.sep, "/")
+
+def member_ipath(name):
+    """Convert the name of an archive member into an internal path.
+
+    Returns None for names which would point outside the bundle tree,
+    such as absolute paths or paths containing "..".
+    """
+    parts = [part for part in name.split("/") if part and part != "."]
+    if name.startswith("/") or not parts or ".." in parts:
+        return None
+
+    ipath = os.path.normpath(os.path.join(*parts))
+    if os.path.isabs(ipath) or os.path.splitdrive(ipath)[0] or \
+       ipath.split(os.sep)[0] == os.pardir:
+        return None
+
+    return ipath
+
+def iter_raw_member(file, info):
+    """Yield the compressed data of an archive member in chunks.
+
+    `file` must be the binary file object the archive was read from.
+    The data is not decompressed or checked.
+    """
+    file.seek(info.header_offset)
+    header = LOCAL_HEADER.unpack(file.read(LOCAL_HEADER.size))
+    if header[0] != LOCAL_HEADER_SIGNATURE:
+        raise Zip.BadZipFile("Bad local file header for member: {}".format(info.filename))
+
+    file.seek(header[LOCAL_HEADER_NAME_LENGTH] + header[LOCAL_HEADER_EXTRA_LENGTH], 1)
+
+    remaining = info.compress_size
+    while remaining > 0:
+        chunk = file.read(min(remaining, COPY_CHUNK_SIZE))
+        if not chunk:
+            raise Zip.BadZipFile("Truncated data for member: {}".format(info.filename))
+
+        remaining -= len(chunk)
+        kbundle.stats.count("bytes_copied", len(chunk))
+        yield chunk
+
+def write_raw_member(zip, info, chunks):
+    """Append a member with already compressed data to an archive.
+
+    `zip` must be a ZipFile open for writing, and `info` must have
+    its `compress_type`, `CRC`, `compress_size` and `file_size`
+    attributes set to describe the data yielded by `chunks`. Since
+    these values are known up front, the local header is complete and
+    no data descriptor is needed.
+    """
+    if info.file_size > Zip.ZIP64_LIMIT or info.compress_size > Zip.ZIP64_LIMIT:
+        raise Zip.LargeZipFile("Filesize would require ZIP64 extensions")
+
+    info.flag_bits &= ~0x08
+
+    # ZipFile wraps non-seekable outputs in an object which only
+    # provides write(), tell() and flush().
+    seekable = getattr(zip.fp, "seekable", None)
+    if seekable is not None and seekable():
+        zip.fp.seek(zip.start_dir)
+    info.header_offset = zip.fp.tell()
+
+    zip.fp.write(info.FileHeader(False))
+    for chunk in chunks:
+        zip.fp.write(chunk)
+
+    zip.filelist.append(info)
+    zip.NameToInfo[info.filename] = info
+    zip.start_dir = zip.fp.tell()
+
+def reproducible_date_time(epoch=None):
+    """Return the timestamp given to every member of a reproducible archive.
+
+    The time is taken from `epoch` (in seconds since the Unix epoch,
+    as a string or number), or else from the SOURCE_DATE_EPOCH
+    environment variable, and is converted in UTC so the result
+    doesn't depend on the local time zone. Without either, the
+    earliest time a ZIP archive can represent is used. Raises
+    ValueError if the time isn't a whole number.
+    """
+    if epoch is None:
+        epoch = os.environ.get("SOURCE_DATE_EPOCH")
+        if not epoch:
+            return ZIP_MIN_DATE_TIME
+
+    try:
+        epoch = int(epoch)
+    except ValueError:
+        raise ValueError("Invalid source date epoch: {}".format(epoch))
+
+    date_time = tuple(time.gmtime(max(epoch, 0))[:6])
+    return min(max(date_time, ZIP_MIN_DATE_TIME), ZIP_MAX_DATE_TIME)
+
+def normalize_info(info, date_time):
+    """Give a member a fixed timestamp and permissions, for reproducible archives."""
+    info.date_time = date_time
+    info.create_system = 3
+    info.external_attr = REPRODUCIBLE_MODE << 16
+
+def read_fingerprint(path):
+    """Return the input fingerprint recorded in a bundle archive, or None.
+
+    Only the end of the archive is read. Archives which can't be read
+    are treated as having no fingerprint.
+    """
+    try:
+        with Zip.ZipFile(path, mode='r') as zip:
+            comment = zip.comment
+    except (OSError, Zip.BadZipFile):
+        return None
+
+    if not comment.startswith(FINGERPRINT_PREFIX):
+        return None
+
+    return comment[len(FINGERPRINT_PREFIX):].decode("ascii", errors="replace")
+
+def stored_info(name, data, date_time=None):
+    """Describe a member storing `data` uncompressed, modified now
+    unless `date_time` is given."""
+    if date_time is None:
+        date_time = time.localtime(time.time())[:6]
+
+    # The permissions are the ones ZipFile.writestr() would give it.
+    info = Zip.ZipInfo(name, date_time=date_time)
+    info.external_attr = 0o600 << 16
+    info.compress_type = Zip.ZIP_STORED
+    info.CRC           = zlib.crc32(data)
+    info.compress_size = len(data)
+    info.file_size     = len(data)
+
+    return info
+
+def precompressed_info(ipath, st, compress_type, crc, compress_size, file_size):
+    """Describe a file whose compressed data is already available."""
+    info = file_info(ipath, st)
+    info.compress_type = compress_type
+    info.CRC           = crc
+    info.compress_size = compress_size
+    info.file_size     = file_size
+
+    return info
+
+def copied_info(ipath, st, base_info):
+    """Describe a file whose compressed data is copied from another archive."""
+    return precompressed_info(ipath, st, base_info.compress_type, base_info.CRC,
+                              base_info.compress_size, base_info.file_size)
+
+class BaseArchive:
+    """A previously built bundle archive whose members can be reused.
+
+    Members are only reused if their contents match the corresponding
+    file in the bundle tree, so they can be copied into a new archive
+    without being decompressed and compressed again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.zip = None
+        self.checksums = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def open(self):
+        """Read the archive directory and embedded manifest.
+
+        Returns False if the archive can't be read.
+        """
+        try:
+            self.file = open(self.path, "rb")
+            self.zip = Zip.ZipFile(self.file, mode='r')
+        except (OSError, Zip.BadZipFile) as e:
+            logger.error("Failed to open bundle file: %s", e)
+            self.close()
+            return False
+
+        # Without an embedded manifest, resources are compared by CRC.
+        manifest = kbundle.manifest.Manifest(kbundle.manifest.MANIFEST_PATH)
+        try:
+            with self.zip.open(kbundle.manifest.MANIFEST_PATH) as manifest_file:
+                if manifest.load(manifest_file):
+                    self.checksums = {path: entry.md5sum
+                                      for path, entry in manifest.entries.items()}
+        except KeyError:
+            pass
+
+        return True
+
+    def close(self):
+        if self.zip is not None:
+            self.zip.close()
+            self.zip = None
+
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def candidate(self, ipath, size):
+        """Find an archive member which could be copied for a file of
+        `size` bytes, judging only by the archive directory.
+
+        Returns the member's ZipInfo, or None.
+        """
+        try:
+            info = self.zip.getinfo(archive_name(ipath))
+        except KeyError:
+            return None
+
+        if info.compress_type not in RAW_COPY_METHODS or info.flag_bits & 0x01:
+            return None
+
+        return info if info.file_size == size else None
+
+    def match(self, ipath, xpath, st, digest=None, crc=None):
+        """Find an archive member with the same contents as a file.
+
+        `st` is the stat result of the file. The member must have the
+        same size and CRC-32 as the file. The
+        file is only read if its CRC-32 `crc` isn't provided. If the
+        MD5 checksum `digest` of the file is provided and the base
+        manifest has an entry for it, the checksums must match as
+        well; the manifest may be out of date, so they are never
+        trusted on their own. Returns the member's ZipInfo, or None if
+        there is no match.
+        """
+        info = self.candidate(ipath, st.st_size)
+        if info is None:
+            return None
+
+        base_digest = self.checksums.get(ipath)
+        if digest is not None and base_digest is not None and digest != base_digest:
+            return None
+
+        if crc is None:
+            crc = crc32sum(xpath)
+
+        return info if crc == info.CRC else None
+
+    def raw_chunks(self, info):
+        """Yield the compressed data of a member in chunks."""
+        return iter_raw_member(self.file, info)
+
+    def read_raw(self, info):
+        """Read the compressed data of a member as a list of chunks.
+
+        The data is decompressed on the way to check it against the
+        member's CRC-32, without compressing it again. Raises
+        BadZipFile or zlib.error if the member is damaged.
+        """
+        decompressor = None
+        if info.compress_type == Zip.ZIP_DEFLATED:
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+
+        crc = 0
+        chunks = []
+        for chunk in self.raw_chunks(info):
+            chunks.append(chunk)
+            crc = zlib.crc32(chunk if decompressor is None else decompressor.decompress(chunk), crc)
+
+        if decompressor is not None:
+            crc = zlib.crc32(decompressor.flush(), crc)
+
+        if crc != info.CRC:
+            raise Zip.BadZipFile("Bad CRC-32 for member: {}".format(info.filename))
+
+        return chunks
@@ -0,0 +1,154 @@
+# Copyright 2023 Quytelda Kahja
+#
+# This file is part of kbundle.
+#
+# kbundle is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kbundle is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with kbundle. If not, see <https://www.gnu.org/licenses/>.
+
+import contextlib
+import io
+import logging
+import os
+import os.path
+import shlex
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import kbundle.bundle
+import kbundle.cache
+import kbundle.compression
+
+logger = logging.getLogger(__name__)
+
+def parse_build_config(path):
+    """Read a list of (root, output) pairs from a build configuration file.
+
+    Each line names a bundle root directory and the bundle file to
+    build from it, separated by whitespace. Paths containing spaces
+    may be quoted. Blank lines and lines starting with '#' are
+    ignored. Relative paths are relative to the configuration file.
+    Raises ValueError for malformed lines.
+    """
+    base_dir = os.path.dirname(os.path.abspath(path))
+    targets = []
+    with open(path, "r", encoding="utf-8") as config_file:
+        for number, line in enumerate(config_file, start=1):
+            if not line.strip() or line.lstrip().startswith("#"):
+                continue
+
+            fields = shlex.split(line)
+            if len(fields) != 2:
+                raise ValueError("Malformed build target on line {}: {}".format(number, line.strip()))
+
+            targets.append(tuple(os.path.join(base_dir, field) for field in fields))
+
+    return targets
+
+def parse_build_target(spec):
+    """Parse a ROOT:OUTPUT build target given on the command line."""
+    root, sep, output = spec.rpartition(":")
+    if not sep or not root or not output:
+        raise ValueError("Build targets must have the form ROOT:OUTPUT: {}".format(spec))
+
+    return root, output
+
+@contextlib.contextmanager
+def capture_logs(stream):
+    """Send everything kbundle logs to a stream instead of the usual handlers."""
+    package_logger = logging.getLogger("kbundle")
+    saved = package_logger.handlers, package_logger.propagate, package_logger.level
+
+    package_logger.handlers = [logging.StreamHandler(stream)]
+    package_logger.propagate = False
+    package_logger.setLevel(logging.INFO)
+    try:
+        yield
+    finally:
+        package_logger.handlers, package_logger.propagate, package_logger.level = saved
+
+def build_bundle(root, output, incremental=True, jobs=1, blob_cache_settings=None,
+                 compression_rules=(), date_time=None):
+    """Update the manifest of a bundle tree while packing it.
+
+    This runs in a worker process, so everything the bundle logs is
+    captured and returned instead. If `blob_cache_settings` is given,
+    it holds the keyword arguments for the BlobCache shared by all
+    workers. `compression_rules` are given to the CompressionPolicy,
+    and `date_time` to Bundle.pack() for reproducible archives.
+    Returns a tuple of the success status, the elapsed time in seconds
+    and the captured output.
+    """
+    start = time.monotonic()
+    log = io.StringIO()
+    ok = False
+    with capture_logs(log), contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        try:
+            bundle = kbundle.bundle.Bundle(root)
+            if not bundle.load():
+                logger.error("Failed to load bundle.")
+            else:
+                base_path = output if incremental and os.path.isfile(output) else None
+                blob_cache = None
+                if blob_cache_settings is not None:
+                    blob_cache = kbundle.cache.BlobCache(**blob_cache_settings)
+
+                policy = kbundle.compression.CompressionPolicy(compression_rules)
+                ok = bundle.pack(output, base_path=base_path, jobs=jobs,
+                                 blob_cache=blob_cache, policy=policy,
+                                 date_time=date_time, update=True)
+        except Exception:
+            traceback.print_exc()
+
+    return ok, time.monotonic() - start, log.getvalue()
+
+def build_all(targets, processes=None, incremental=True, jobs=1, verbose=False,
+              blob_cache_settings=None, compression_rules=(), date_time=None):
+    """Build several bundles in parallel using a pool of processes.
+
+    `targets` is a list of (root, output) pairs. A failure to build
+    one bundle doesn't stop the others. Progress is reported as each
+    bundle finishes, followed by a summary. Returns True if every
+    bundle was built.
+    """
+    start = time.monotonic()
+    failures = []
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = {executor.submit(build_bundle, root, output, incremental, jobs,
+                                   blob_cache_settings, compression_rules,
+                                   date_time): (root, output)
+                   for root, output in targets}
+
+        for done, future in enumerate(as_completed(futures), start=1):
+            root, output = futures[future]
+            try:
+                ok, elapsed, log = future.result()
+            except Exception as e:
+                ok, elapsed, log = False, 0.0, "{}\n".format(e)
+
+            logger.info("[%d/%d] %s %s -> %s (%.2fs)", done, len(targets),
+                        "OK" if ok else "FAILED", root, output, elapsed)
+            if not ok:
+                failures.append(root)
+                if log:
+                    logger.error(log.rstrip("\n"))
+            elif verbose and log:
+                logger.info(log.rstrip("\n"))
+
+    logger.info("Built %d of %d bundles in %.2fs.",
+                len(targets) - len(failures), len(targets), time.monotonic() - start)
+    for root in failures:
+        logger.error("Failed: %s", root)
+
+    return not failures
@@ -15,14 +15,34 @@
 # You should have received a copy of the GNU General Public License
 # along with kbundle. If not, see <https://www.gnu.org/licenses/>.
 
+import contextlib
+import fnmatch
+import functools
+import glob
 import hashlib
-import sys
+import json
+import logging
 import os.path
+import stat
 import zipfile as Zip
 import zlib
 import pprint
+import shutil
+import time
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
+import kbundle.archive
+import kbundle.cache
+import kbundle.compression
+import kbundle.fileutil
+import kbundle.kpp
 import kbundle.manifest
+import kbundle.scan
+import kbundle.stats
+
+logger = logging.getLogger(__name__)
 
 # The mimetype string is written to the first entry of a bundle ZIP archive.
 BUNDLE_MIMETYPE = b'application/x-krita-resourcebundle'
@@ -37,23 +57,13 @@ RESOURCE_DIR_NAMES = ["brushes",
                       "seexpr_scripts",
                       "workspaces"]
 
+# Operations accepted by Bundle.apply_tag_operations().
+TAG_OPERATIONS = ("add", "remove")
+
 def is_visible(filename):
     """Test that a file is not a hidden dotfile."""
     return not filename.startswith('.')
 
-def list_recursively(dirname):
-    """Walk a directory tree and return a list of all files it contains."""
-    results = []
-    for current_dir, subdirs, files in os.walk(dirname):
-        # Prune dotfiles
-        subdirs[:] = filter(is_visible, subdirs)
-        files[:]   = filter(is_visible, files)
-
-        dirpath = os.path.abspath(current_dir)
-        results += map(lambda filename: os.path.join(dirpath, filename), files)
-
-    return results
-
 def topmost_dir_name(path):
     """Return the first (top-level) directory name in a path.
 
@@ -74,14 +84,110 @@ def topmost_dir_name(path):
 
     return tail
 
+# Files are hashed in chunks of this many bytes, so memory use doesn't
+# depend on the size of the file.
+HASH_CHUNK_SIZE = 1024 * 1024
+
+def is_resource_path(ipath):
+    """Test whether an internal path names a file in a resource directory.
+
+    The path must be inside one of the `RESOURCE_DIR_NAMES`
+    directories and must not contain any hidden components.
+    """
+    parts = os.path.normpath(ipath).split(os.sep)
+    return (len(parts) > 1
+            and parts[0] in RESOURCE_DIR_NAMES
+            and all(map(is_visible, parts)))
+
+def parse_tag_operations(lines):
+    """Parse tag operations, one per line, from an iterable of strings.
+
+    Each line contains an operation ("add" or "remove"), a tag and a
+    resource path or glob pattern, separated by tabs. Blank lines and
+    lines starting with '#' are ignored. Yields (operation, tag, path)
+    tuples, and raises ValueError for malformed lines.
+    """
+    for number, line in enumerate(lines, start=1):
+        line = line.rstrip("\r\n")
+        if not line.strip() or line.startswith("#"):
+            continue
+
+        fields = line.split("\t")
+        if len(fields) != 3 or fields[0] not in TAG_OPERATIONS:
+            raise ValueError("Malformed tag operation on line {}: {}".format(number, line))
+
+        yield tuple(fields)
+
 def md5sum(path):
     """Return the MD5 checksum of the file at the provided path."""
     alg = hashlib.md5()
     with open(path, "rb") as file:
-        alg.update(file.read())
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+            alg.update(chunk)
+            kbundle.stats.count("bytes_read", len(chunk))
+            kbundle.stats.count("bytes_hashed", len(chunk))
 
+    kbundle.stats.count("files_hashed")
     return alg.hexdigest()
 
+def file_checksums(path):
+    """Return the MD5 checksum and CRC-32 of the file at the provided path."""
+    alg = hashlib.md5()
+    crc = 0
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+            alg.update(chunk)
+            crc = zlib.crc32(chunk, crc)
+            kbundle.stats.count("bytes_read", len(chunk))
+            kbundle.stats.count("bytes_hashed", len(chunk))
+
+    kbundle.stats.count("files_hashed")
+    return alg.hexdigest(), crc
+
+def parallel_map(func, items, jobs=None):
+    """Apply a function to each item using a pool of worker threads.
+
+    The results are returned as a list in the same order as `items`,
+    regardless of the order in which the workers finish. At most
+    `jobs` threads are used; if `jobs` is None, the default number of
+    workers for a ThreadPoolExecutor is used.
+    """
+    items = list(items)
+    if jobs == 1 or len(items) < 2:
+        return [func(item) for item in items]
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(func, items))
+
+def parallel_imap(func, items, jobs=None):
+    """Lazily apply a function to each item using a pool of worker threads.
+
+    Like parallel_map(), results are yielded in the same order as
+    `items`. Only a couple of items per worker are processed ahead of
+    the consumer, so large results don't pile up in memory. If `jobs`
+    is None, one worker per CPU is used.
+    """
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+
+    if jobs == 1:
+        yield from map(func, items)
+        return
+
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = deque(executor.submit(func, item)
+                        for item in itertools.islice(items, 2 * jobs))
+        while pending:
+            result = pending.popleft().result()
+            pending.extend(executor.submit(func, item)
+                           for item in itertools.islice(items, 1))
+            yield result
+
+# Changing how archives are written must change this, so that the
+# fingerprints of reproducible archives built before no longer match.
+FINGERPRINT_VERSION = 3
+
 # Zip Compression Options
 # https://docs.oasis-open.org/office/v1.2/os/OpenDocument-v1.2-os-part3.html
 ZIP_OPTIONS = {
@@ -90,6 +196,31 @@ ZIP_OPTIONS = {
     "compresslevel" : zlib.Z_DEFAULT_COMPRESSION
 }
 
+class PackSettings:
+    """The settings shared by every member of an archive being packed.
+
+    See Bundle.pack() for the meaning of each setting. Resources are
+    hashed while packing if they need checksums to be matched against
+    the base archive or the blob cache, for a reproducible archive's
+    fingerprint, or for updating the manifest.
+    """
+
+    def __init__(self, policy, base=None, blob_cache=None, date_time=None, update=False):
+        self.policy = policy
+        self.base = base
+        self.blob_cache = blob_cache
+        self.date_time = date_time
+        self.hash_resources = update or base is not None or blob_cache is not None or \
+            date_time is not None
+
+    def normalize(self, info):
+        """Give a member the fixed timestamp and permissions of a
+        reproducible archive, if one is being built."""
+        if self.date_time is not None:
+            kbundle.archive.normalize_info(info, self.date_time)
+
+        return info
+
 class Bundle:
     """A class representing a Krita resource bundle."""
 
@@ -99,57 +230,172 @@ class Bundle:
         self.manifest = kbundle.manifest.Manifest(manifest_path)
         self.resources = []
 
-    def load(self):
+        # The stat results of resource files from the last scan, which
+        # are used instead of calling stat() on each file again.
+        self.stats = {}
+        self.ignore_rules = kbundle.scan.IgnoreRules()
+
+        cache_path = self.__external_path(os.path.join(kbundle.cache.CACHE_DIR_NAME,
+                                                       kbundle.cache.STAT_CACHE_NAME))
+        self.stat_cache = kbundle.cache.StatCache(cache_path)
+
+    def load(self, scan=True):
+        """Load the manifest and, if `scan` is True, scan for resource files.
+
+        Commands which only work with the manifest (such as tagging)
+        don't need to scan the bundle tree.
+        """
         if self.manifest.exists() and not self.manifest.load():
-            print("Failed to load manifest file.", file=sys.stderr)
+            logger.error("Failed to load manifest file.")
             return False
 
-        if not self.scan_files():
-            print("Failed to scan bundle directory.", file=sys.stderr)
+        if scan and not self.scan_files():
+            logger.error("Failed to scan bundle directory.")
             return False
 
         return True
 
     def scan_files(self):
+        """Find the resource files in the bundle tree.
+
+        Files matching the patterns in the bundle's .kbundleignore
+        file are left out.
+        """
         if not os.path.isdir(self.root):
-            print("Bundle directory does not exist: {}".format(self.root), file=sys.stderr)
+            logger.error("Bundle directory does not exist: %s", self.root)
             return False
 
-        self.resources.clear()
+        if not self.__load_ignore_rules():
+            return False
 
-        for dirname in RESOURCE_DIR_NAMES:
-            dirpath = self.__external_path(dirname)
-            if not os.path.isdir(dirpath):
-                continue
+        self.resources.clear()
+        self.stats.clear()
 
-            resource_paths = list_recursively(dirpath)
-            self.resources += map(self.__internal_path, resource_paths)
+        with kbundle.stats.phase("scan"):
+            for ipath, st in kbundle.scan.scan_tree(self.root, RESOURCE_DIR_NAMES,
+                                                    self.ignore_rules):
+                self.resources.append(ipath)
+                if st is not None:
+                    self.stats[ipath] = st
 
+        kbundle.stats.count("files_scanned", len(self.resources))
         return True
 
-    def update_manifest(self):
+    def update_manifest(self, use_cache=True, jobs=None):
         if not self.resources:
             return False
 
-        # common contains resources present in the manifest and on-disk.
-        # mf_only contains resources listed only in the manifest.
-        # file_only contains resources present on-disk, but not in the manifest.
-        common, mf_only, file_only = self.manifest.compare_entries(self.resources)
+        # Checksums of files which haven't changed since the last
+        # update are reused from the stat cache instead of rehashing.
+        if use_cache:
+            self.stat_cache.load()
+        else:
+            self.stat_cache.clear()
 
-        # Remove resources that exist in the manifest but not on disk
-        for ipath in mf_only:
-            if not self.__remove_entry(ipath, info="REMOVE"):
-                return False
+        checksums = self.__checksums(self.resources, jobs)
+        if checksums is None:
+            return False
 
-        for ipath in file_only:
-            if not self.__insert_entry(ipath, info="INSERT"):
-                return False
+        self.__apply_checksums(checksums)
+        self.manifest.save()
+        self.__save_stat_cache()
+        return True
 
-        for ipath in common:
-            if not self.__insert_entry(ipath, info="UPDATE"):
-                return False
+    def update_paths(self, paths, jobs=None, use_cache=True):
+        """Update the manifest entries for the given files and directories.
 
+        Paths may be relative to the bundle root or to the current
+        directory. Only the given paths are scanned and hashed, so
+        the bundle tree doesn't need to be scanned first. See
+        update_entries().
+        """
+        if not os.path.isdir(self.root):
+            logger.error("Bundle directory does not exist: %s", self.root)
+            return False
+
+        if not self.__load_ignore_rules():
+            return False
+
+        ipaths = [os.path.normpath(self.__internal_path(path)) for path in paths]
+        for ipath in ipaths:
+            xpath = self.__external_path(ipath)
+            if not os.path.exists(xpath):
+                if not self.__entries_under(ipath):
+                    logger.warning("No such file or manifest entry: %s", ipath)
+            elif ipath != os.curdir and ipath not in RESOURCE_DIR_NAMES and \
+                 not is_resource_path(ipath):
+                logger.warning("Not a resource file or directory: %s", ipath)
+            elif ipath != os.curdir and self.ignore_rules.ignores_path(ipath):
+                logger.warning("Ignored by %s: %s", kbundle.scan.IGNORE_FILE_NAME, ipath)
+
+        return self.update_entries(ipaths, jobs=jobs, use_cache=use_cache)
+
+    def update_entries(self, ipaths, jobs=None, use_cache=True):
+        """Update the manifest entries for some resources only.
+
+        Each internal path may name a resource file or a directory.
+        Directories stand for all of the resources they contain.
+        Entries are inserted or updated for the resource files which
+        exist, and removed for paths which no longer exist. Entries
+        and cached checksums for all other resources are left alone.
+        """
+        if use_cache:
+            self.stat_cache.load()
+        else:
+            self.stat_cache.clear()
+
+        # The bundle root stands for every resource directory,
+        # including those which no longer exist but still have
+        # manifest entries.
+        ipaths = [os.path.normpath(ipath) for ipath in ipaths]
+        if os.curdir in ipaths:
+            ipaths = [ipath for ipath in ipaths if ipath != os.curdir] + list(RESOURCE_DIR_NAMES)
+
+        present = set()
+        removed = set()
+        for ipath in ipaths:
+            xpath = self.__external_path(ipath)
+            if os.path.isdir(xpath) and not self.ignore_rules.ignores_path(ipath):
+                found = set()
+                for file_ipath, st in kbundle.scan.scan_tree(self.root, [ipath],
+                                                             self.ignore_rules):
+                    if is_resource_path(file_ipath):
+                        found.add(file_ipath)
+                        self.__remember_stat(file_ipath, st)
+                present |= found
+                removed |= set(self.__entries_under(ipath)) - found
+            elif os.path.isfile(xpath) and is_resource_path(ipath) and \
+                 not self.ignore_rules.ignores_path(ipath):
+                present.add(ipath)
+                self.__remember_stat(ipath, os.stat(xpath))
+            elif not os.path.isfile(xpath):
+                removed.update(self.__entries_under(ipath))
+
+        removed -= present
+        for ipath in removed:
+            self.stats.pop(ipath, None)
+
+        for ipath in sorted(removed):
+            self.__remove_entry(ipath, info="REMOVE")
+
+        updates = sorted(present)
+        checksums = self.__checksums(updates, jobs)
+        if checksums is None:
+            return False
+
+        for ipath in updates:
+            info = "UPDATE" if self.manifest.has_entry(ipath) else "INSERT"
+            self.__insert_entry(ipath, checksums[ipath], info=info)
+
+        known = set(self.resources)
+        self.resources = [ipath for ipath in self.resources if ipath not in removed]
+        self.resources += [ipath for ipath in updates if ipath not in known]
+
+        # The rest of the bundle may not have been scanned, so only
+        # the records of removed resources are dropped.
         self.manifest.save()
+        self.stat_cache.forget(removed)
+        self.__save_stat_cache(prune=False)
         return True
 
     def print_manifest_entries(self):
@@ -161,16 +407,16 @@ class Bundle:
 
         tags = self.manifest.tags(ipath)
         if tags is None:
-            print("No matching entry in manifest: {}".format(ipath), file=sys.stderr)
+            logger.error("No matching entry in manifest: %s", ipath)
             return False
 
-        pprint.pprint(tags)
+        pprint.pprint(list(tags))
         return True
 
     def add_tag(self, path, tag):
         ipath = self.__internal_path(path)
         if not self.manifest.add_tag(ipath, tag):
-            print("Failed to add tag for resource: {}".format(ipath), file=sys.stderr)
+            logger.error("Failed to add tag for resource: %s", ipath)
             return False
 
         self.print_tags(path)
@@ -180,44 +426,403 @@ class Bundle:
     def remove_tag(self, path, tag):
         ipath = self.__internal_path(path)
         if not self.manifest.remove_tag(ipath, tag):
-            print("Failed to remove tag for resource: {}".format(ipath), file=sys.stderr)
+            logger.error("Failed to remove tag for resource: %s", ipath)
             return False
 
         self.print_tags(path)
         self.manifest.save()
         return True
 
-    def unpack(self, archive_path):
-        with Zip.ZipFile(archive_path, mode='r', **ZIP_OPTIONS) as zip:
-            zip.extractall(path=self.root)
+    def apply_tag_operations(self, operations):
+        """Add or remove tags for many resources, saving the manifest once.
+
+        `operations` is an iterable of (operation, tag, path) tuples,
+        where the operation is either "add" or "remove". The path may
+        be a glob pattern, in which case the operation applies to all
+        matching manifest entries. Operations which fail are reported
+        and skipped. Returns True if every operation succeeded.
+        """
+        ok = True
+        changed = False
+        for operation, tag, path in operations:
+            ipaths = self.__matching_entries(path)
+            if not ipaths:
+                logger.error("No matching entry in manifest: %s", path)
+                ok = False
+                continue
+
+            for ipath in ipaths:
+                if operation == "add":
+                    done = self.manifest.add_tag(ipath, tag)
+                else:
+                    done = self.manifest.remove_tag(ipath, tag)
+
+                if not done:
+                    logger.error("Failed to %s tag '%s' for resource: %s", operation, tag, ipath)
+                    ok = False
+                    continue
+
+                logger.info("%s: %s %s", operation.upper(), ipath, tag)
+                changed = True
+
+        if changed:
+            self.manifest.save()
+
+        return ok
+
+    def rename_presets(self, paths, name=None, jobs=None):
+        """Change the names stored in paintop preset files.
+
+        Each path may name a preset file or a directory of presets. If
+        no name is given, each preset is named after its file. Files
+        are rewritten by up to `jobs` worker threads, then the
+        manifest entries of the changed files are updated. Only the
+        given paths are scanned, so the bundle tree doesn't need to be
+        scanned first. Returns True if every preset was renamed.
+        """
+        if not self.__load_ignore_rules():
+            return False
+
+        ipaths = []
+        for path in paths:
+            xpath = self.__external_path(self.__internal_path(path))
+            if os.path.isdir(xpath):
+                ipaths += sorted(ipath for ipath, _ in
+                                 kbundle.scan.scan_tree(self.root, [self.__internal_path(path)],
+                                                        self.ignore_rules)
+                                 if kbundle.kpp.is_preset_path(ipath))
+            else:
+                ipaths.append(self.__internal_path(path))
+
+        if not ipaths:
+            logger.error("No presets found.")
+            return False
+
+        if name is not None and len(ipaths) != 1:
+            logger.error("A preset name can only be given for a single preset.")
+            return False
+
+        def rename(ipath):
+            try:
+                return kbundle.kpp.rename_preset(self.__external_path(ipath), name)
+            except (OSError, kbundle.kpp.PresetError) as e:
+                return e
+
+        ok = True
+        changed = []
+        for ipath, result in zip(ipaths, parallel_imap(rename, ipaths, jobs)):
+            if isinstance(result, Exception):
+                logger.error("Failed to rename preset %s: %s", ipath, result)
+                ok = False
+                continue
+
+            old_name, new_name = result
+            if old_name != new_name:
+                logger.info("RENAME: %s \"%s\" -> \"%s\"", ipath, old_name, new_name)
+                changed.append(ipath)
 
-        # Remove the extraneous "mimetype" file. The file is
-        # automatically inserted into bundle archives, so storing it
-        # is unecessary.
-        os.remove(self.__external_path("mimetype"))
+        # Only the checksums of the rewritten files need updating.
+        changed = [ipath for ipath in changed if self.manifest.has_entry(ipath)]
+        if changed and not self.update_entries(changed, jobs):
+            return False
+
+        return ok
+
+    def print_query(self, tags=(), media_type=None, prefix=None, untagged=False,
+                    output_format="paths"):
+        """Print the manifest entries matching a query.
+
+        See Manifest.query() for the meaning of the criteria. The
+        output format is either "paths" (one path per line) or "json"
+        (one JSON object per line describing each entry).
+        """
+        if prefix is not None:
+            prefix = self.__internal_path(prefix)
+
+        paths = self.manifest.query(tags, media_type, prefix, untagged)
+        for path in paths:
+            if output_format == "json":
+                entry = self.manifest.entries[path]
+                print(json.dumps({"path"      : path.replace(os.sep, "/"),
+                                  "media_type": entry.media_type,
+                                  "md5sum"    : entry.md5sum,
+                                  "tags"      : entry.tags}))
+            else:
+                print(path)
 
         return True
 
-    def pack(self, archive_path):
-        with Zip.ZipFile(archive_path, mode='w', **ZIP_OPTIONS) as zip:
+    def print_presets(self, paintop=None, name=None, resource=None, output_format="table",
+                      jobs=None):
+        """Print the metadata of the presets in the manifest.
+
+        Metadata is cached by manifest checksum in the bundle's cache
+        directory, so only new or changed presets are read. Presets
+        can be filtered by paintop ID, by a glob pattern matching the
+        preset name and by the file name of a resource they use. The
+        output format is either "table" (path, name and paintop
+        separated by tabs) or "json" (one JSON object per preset).
+        """
+        cache = kbundle.cache.PresetCache(
+            self.__external_path(os.path.join(kbundle.cache.CACHE_DIR_NAME,
+                                              kbundle.cache.PRESET_CACHE_NAME)))
+        cache.load()
+
+        ipaths = [ipath for ipath in self.manifest.query(media_type="paintoppresets")
+                  if kbundle.kpp.is_preset_path(ipath)]
 
-            def zip_add_file(ipath):
-                xpath = self.__external_path(ipath)
-                zip.write(xpath, arcname=ipath)
+        presets = {}
+        missing = []
+        for ipath in ipaths:
+            metadata = cache.lookup(ipath, self.manifest.entries[ipath].md5sum)
+            if metadata is None:
+                missing.append(ipath)
+            else:
+                presets[ipath] = metadata
 
-            # The mimetype file must be the first entry in the
-            # archive. It must contain only the ASCII-encoded
-            # mime-type string and be uncompressed.
-            zip.writestr("mimetype", BUNDLE_MIMETYPE,
-                         compress_type=Zip.ZIP_STORED,
-                         compresslevel=zlib.Z_NO_COMPRESSION)
+        def read(ipath):
+            kbundle.stats.count("presets_read")
+            try:
+                return kbundle.kpp.read_preset_metadata(self.__external_path(ipath))
+            except (OSError, kbundle.kpp.PresetError) as e:
+                return e
 
-            for ipath in self.resources:
-                zip_add_file(ipath)
+        ok = True
+        with kbundle.stats.phase("presets"):
+            for ipath, result in zip(missing, parallel_map(read, missing, jobs)):
+                if isinstance(result, Exception):
+                    logger.error("Failed to read preset %s: %s", ipath, result)
+                    ok = False
+                    continue
+
+                cache.store(ipath, self.manifest.entries[ipath].md5sum, result)
+                presets[ipath] = result
+
+        cache.prune(ipaths)
+        cache.save()
+
+        for ipath in ipaths:
+            metadata = presets.get(ipath)
+            if metadata is None or \
+               (paintop is not None and metadata["paintop"] != paintop) or \
+               (name is not None and not fnmatch.fnmatchcase(metadata["name"], name)) or \
+               (resource is not None and
+                all(ref["filename"] != resource for ref in metadata["resources"])):
+                continue
+
+            if output_format == "json":
+                print(json.dumps({"path": ipath.replace(os.sep, "/"), **metadata}))
+            else:
+                print("{}\t{}\t{}".format(ipath, metadata["name"], metadata["paintop"]))
+
+        return ok
+
+    def unpack(self, archive_path, jobs=None, incremental=False, patterns=(), media_types=()):
+        """Extract a bundle archive into the bundle tree.
+
+        Members are extracted by up to `jobs` worker threads, and each
+        file is replaced atomically. If `incremental` is True, members
+        whose contents match the file already on disk are skipped, so
+        the file isn't touched. Files are compared with the size and
+        CRC-32 in the archive directory, using the CRC-32 from the stat
+        cache where possible. The embedded manifest's checksum is only
+        compared as an extra check.
+
+        If glob `patterns` (matched against member names) or
+        `media_types` are given, only matching members are extracted.
+        The "mimetype" member is never extracted, since it is inserted
+        automatically when packing.
+        """
+        archive = kbundle.archive.BaseArchive(archive_path)
+        if not archive.open():
+            return False
+
+        if incremental:
+            self.stat_cache.load()
+
+        def selected(name, ipath):
+            if patterns and not any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns):
+                return False
 
-            zip_add_file("preview.png")
-            zip_add_file(kbundle.manifest.MANIFEST_PATH)
-            zip_add_file("meta.xml")
+            return not media_types or topmost_dir_name(ipath) in media_types
+
+        def extract(member):
+            """Extract a member unless it matches the file on disk.
+            Returns True if the file was written."""
+            ipath, info = member
+            xpath = self.__external_path(ipath)
+            if info.is_dir():
+                os.makedirs(xpath, exist_ok=True)
+                return False
+
+            if incremental and os.path.isfile(xpath):
+                st = os.stat(xpath)
+                digest = self.stat_cache.lookup(ipath, st)
+                if archive.match(ipath, xpath, st, digest, self.stat_cache.crc(ipath, st)) is not None:
+                    return False
+
+            os.makedirs(os.path.dirname(xpath), exist_ok=True)
+            with archive.zip.open(info) as member_file, \
+                 kbundle.fileutil.atomic_write(xpath) as output_file:
+                shutil.copyfileobj(member_file, output_file, kbundle.archive.COPY_CHUNK_SIZE)
+
+            kbundle.stats.count("bytes_extracted", info.file_size)
+            return True
+
+        with archive, kbundle.stats.phase("unpack"):
+            members = []
+            for info in archive.zip.infolist():
+                if info.filename == "mimetype":
+                    continue
+
+                ipath = kbundle.archive.member_ipath(info.filename)
+                if ipath is None:
+                    logger.warning("Skipping member outside the bundle tree: %s", info.filename)
+                elif selected(info.filename, ipath):
+                    members.append((ipath, info))
+
+            try:
+                extracted = sum(parallel_map(extract, members, jobs))
+            except (OSError, Zip.BadZipFile, zlib.error) as e:
+                logger.error("Failed to unpack bundle: %s", e)
+                return False
+
+        kbundle.stats.count("files_extracted", extracted)
+        logger.info("Extracted %d of %d files.", extracted,
+                    sum(not info.is_dir() for _, info in members))
+        return True
+
+    def pack(self, archive, base_path=None, jobs=None, blob_cache=None, policy=None,
+             date_time=None, force=False, update=False):
+        """Build a bundle archive from the bundle tree.
+
+        `archive` is either the path of the bundle file to write, or a
+        writable binary file object. File objects don't need to be
+        seekable, so the archive can be streamed to a pipe or socket;
+        each member is written as soon as it has been compressed.
+
+        Files are compressed by up to `jobs` worker threads, but are
+        always written in the same order, so the output doesn't
+        depend on the number of workers.
+
+        If `base_path` names a previously built archive, the
+        compressed data of members whose contents haven't changed is
+        copied from it instead of compressing the files again. The
+        base may be the same file as the output archive.
+
+        If a BlobCache is given, compressed data is looked up in it by
+        checksum before compressing a resource, and newly compressed
+        data is added to it. Resources whose checksums aren't in the
+        stat cache are read only once, with each chunk going to both
+        MD5 and the compressor.
+
+        Whether each file is deflated or stored, and at which level,
+        is decided by a CompressionPolicy (by default, one with only
+        the default rules).
+
+        Resources are always written in sorted order. If `date_time` is
+        given, the archive is reproducible: every member gets that
+        timestamp and the same permissions, and a fingerprint of the
+        inputs is recorded in the archive comment. If the output file
+        already has the same fingerprint, it is left alone unless
+        `force` is True.
+
+        If `update` is True, the manifest is updated as part of
+        packing, and is saved once the checksums of all resources are
+        known. The manifest is always the last member of the archive.
+        """
+        if policy is None:
+            policy = kbundle.compression.CompressionPolicy()
+
+        is_path = isinstance(archive, (str, bytes, os.PathLike))
+        resources = sorted(self.resources, key=kbundle.archive.archive_name)
+
+        base = None
+        if base_path is not None:
+            base = kbundle.archive.BaseArchive(base_path)
+            if not base.open():
+                return False
+
+        settings = PackSettings(policy, base, blob_cache, date_time, update)
+        with base if base is not None else contextlib.nullcontext():
+            checksums = self.__plan_members(resources, settings)
+            if checksums is None:
+                return False
+
+            # If every checksum is cached, the manifest can be brought
+            # up to date right away.
+            manifest_ready = not update
+            if update and len(checksums) == len(resources):
+                self.__apply_checksums(checksums)
+                self.manifest.save()
+                manifest_ready = True
+
+            fingerprint = None
+            if date_time is not None and manifest_ready and len(checksums) == len(resources):
+                try:
+                    fingerprint = self.__fingerprint(checksums, policy, date_time)
+                except OSError as e:
+                    logger.error("Failed to read bundle file: %s", e)
+                    return False
+
+                if is_path and not force and \
+                   kbundle.archive.read_fingerprint(archive) == fingerprint:
+                    self.__save_stat_cache()
+                    logger.info("Bundle file is up to date: %s", archive)
+                    return True
+
+            # Bundle files are written to a temporary file first, so the
+            # base archive can be read while the output is replacing it.
+            if is_path:
+                output = kbundle.fileutil.atomic_write(archive)
+            else:
+                output = contextlib.nullcontext(archive)
+
+            try:
+                with kbundle.stats.phase("pack"), \
+                     output as archive_file, \
+                     Zip.ZipFile(archive_file, mode='w', **ZIP_OPTIONS) as zip:
+
+                    # The mimetype file must be the first entry in the
+                    # archive. It must contain only the ASCII-encoded
+                    # mime-type string and be uncompressed. Writing it
+                    # directly avoids the data descriptor ZipFile would
+                    # add for a non-seekable output.
+                    info = kbundle.archive.stored_info("mimetype", BUNDLE_MIMETYPE, date_time)
+                    kbundle.archive.write_raw_member(zip, settings.normalize(info),
+                                                     [BUNDLE_MIMETYPE])
+
+                    if fingerprint is not None:
+                        zip.comment = kbundle.archive.FINGERPRINT_PREFIX + \
+                            fingerprint.encode("ascii")
+
+                    # The manifest is written last, since packing may
+                    # update it.
+                    copied, compressed = self.__write_members(
+                        zip, resources + ["preview.png", "meta.xml"], checksums, settings, jobs)
+                    if self.__finish_manifest(zip, checksums, settings,
+                                              manifest_ready, fingerprint):
+                        copied += 1
+                    else:
+                        compressed += 1
+            except (OSError, Zip.BadZipFile, zlib.error) as e:
+                logger.error("Failed to pack bundle: %s", e)
+                return False
+
+        if base is not None:
+            logger.info("Copied %d unchanged members from %s, compressed %d.",
+                        copied, base_path, compressed)
+
+        if blob_cache is not None:
+            blob_cache.evict()
+            logger.info(blob_cache.summary())
+
+        summary = policy.summary()
+        if summary is not None:
+            logger.info(summary)
+
+        if checksums:
+            self.__save_stat_cache()
 
         return True
 
@@ -237,30 +842,346 @@ class Bundle:
 
         return path if relative else os.path.relpath(abs_path, start=self.root)
 
-    def __generate_entry(self, xpath):
-        """Generate a manifest entry for a bundle resource."""
-        if not os.path.isfile(xpath):
-            print("Not a resource file: {}".format(xpath), file=sys.stderr)
-            return None
+    def __load_ignore_rules(self):
+        """Read the bundle's ignore file. Returns False if it can't be read."""
+        try:
+            self.ignore_rules = kbundle.scan.IgnoreRules.load(self.root)
+        except OSError as e:
+            logger.error("Failed to read ignore file: %s", e)
+            return False
 
-        ipath = self.__internal_path(xpath)
+        return True
 
+    def __generate_entry(self, ipath, digest):
+        """Generate a manifest entry for a bundle resource."""
         return kbundle.manifest.ManifestEntry(full_path  = ipath,
                                               media_type = topmost_dir_name(ipath),
-                                              md5sum     = md5sum(xpath),
-                                              tags       = [])
+                                              md5sum     = digest,
+                                              tags       = ())
+
+    def __checksums(self, ipaths, jobs=None):
+        """Compute the MD5 checksums of several resources.
+
+        Checksums are reused from the stat cache where possible, and
+        the remaining files are hashed by up to `jobs` worker threads.
+        Returns a dictionary mapping internal paths to checksums, or
+        None if any of the files couldn't be read.
+        """
+        checksums = {}
+        pending = []
+        for ipath in ipaths:
+            xpath = self.__external_path(ipath)
+            try:
+                st = self.__stat(ipath)
+            except OSError:
+                st = None
+
+            if st is None or not stat.S_ISREG(st.st_mode):
+                logger.error("Not a resource file: %s", xpath)
+                return None
+
+            digest = self.stat_cache.lookup(ipath, st)
+            if digest is None:
+                pending.append((ipath, xpath, st))
+            else:
+                checksums[ipath] = digest
+
+        try:
+            with kbundle.stats.phase("hash"):
+                results = parallel_map(file_checksums, [xpath for _, xpath, _ in pending], jobs)
+        except OSError as e:
+            logger.error("Failed to read resource file: %s", e)
+            return None
+
+        for (ipath, _, st), (digest, crc) in zip(pending, results):
+            self.stat_cache.store(ipath, st, digest, crc)
+            checksums[ipath] = digest
+
+        return checksums
+
+    def __plan_members(self, resources, settings):
+        """Look up the checksums already known before packing.
+
+        Checksums which aren't cached yet are computed while
+        compressing, so each file is only read once. Returns a
+        dictionary mapping internal paths to checksums (empty if
+        packing doesn't need them), or None if any of the resources
+        isn't a regular file.
+        """
+        if not settings.hash_resources:
+            return {}
+
+        self.stat_cache.load()
+        return self.__cached_checksums(resources)
+
+    def __write_members(self, zip, ipaths, checksums, settings, jobs=None):
+        """Compress files and append them to an archive in order.
 
-    def __insert_entry(self, ipath, info="INSERT"):
-        print("{}: {}".format(info, ipath))
+        Files are compressed by up to `jobs` worker threads. Checksums
+        computed along the way are added to `checksums` and the stat
+        cache. Returns the number of members copied from the base
+        archive and the number compressed.
+        """
+        copied = 0
+        compressed = 0
+        compress = functools.partial(self.__compress_member, checksums=checksums,
+                                     settings=settings)
+        for index, (info, chunks, base_info, hashed) in \
+                enumerate(parallel_imap(compress, ipaths, jobs)):
+            if hashed is not None:
+                ipath, st, checksums[ipath] = hashed
+                self.stat_cache.store(ipath, st, checksums[ipath], info.CRC)
+
+            # Copied data is read and checked before anything is
+            # written, so a damaged base member can still be replaced
+            # by compressing the file.
+            if base_info is not None:
+                try:
+                    chunks = settings.base.read_raw(base_info)
+                except (OSError, Zip.BadZipFile, zlib.error) as e:
+                    logger.warning("Failed to copy %s from the base archive, "
+                                   "compressing it instead: %s", ipaths[index], e)
+                    info, chunks, base_info, _ = self.__compress_member(
+                        ipaths[index], checksums, settings, use_base=False)
+
+            if base_info is None:
+                compressed += 1
+            else:
+                copied += 1
+
+            kbundle.archive.write_raw_member(zip, info, chunks)
+
+        return copied, compressed
+
+    def __finish_manifest(self, zip, checksums, settings, manifest_ready, fingerprint):
+        """Write the manifest as the last member of an archive.
+
+        Unless `manifest_ready` is True, the manifest is first brought
+        up to date with `checksums` and saved. A reproducible archive
+        gets its fingerprint now if it doesn't have one yet. Returns
+        True if the manifest was copied from the base archive.
+        """
+        if not manifest_ready:
+            self.__apply_checksums(checksums)
+            self.manifest.save()
+
+        if settings.date_time is not None and fingerprint is None:
+            fingerprint = self.__fingerprint(checksums, settings.policy, settings.date_time)
+            zip.comment = kbundle.archive.FINGERPRINT_PREFIX + fingerprint.encode("ascii")
+
+        copied, _ = self.__write_members(zip, [kbundle.manifest.MANIFEST_PATH],
+                                         checksums, settings, jobs=1)
+        return copied > 0
+
+    def __compress_member(self, ipath, checksums, settings, use_base=True):
+        """Prepare a file for inclusion in an archive.
+
+        Returns the member's ZipInfo, either its compressed data or
+        the ZipInfo of the base archive member to copy, and the
+        internal path, stat result and checksum of the file if it was
+        hashed. The base archive is ignored if `use_base` is False.
+        """
         xpath = self.__external_path(ipath)
-        entry = self.__generate_entry(xpath)
-        if entry is None:
-            print("Failed to create entry for file: {}".format(xpath), file=sys.stderr)
-            return False
+        media_type = topmost_dir_name(ipath)
+        st = self.__stat(ipath)
+        policy = settings.policy
+        base = settings.base if use_base else None
+        blob_cache = settings.blob_cache
+
+        # Without a checksum, the file can't be matched against the
+        # blob cache without reading it, so it is hashed while it is
+        # compressed. Only if the base archive has a member of the
+        # same size is it worth hashing the file first.
+        digest = checksums.get(ipath)
+        crc = self.stat_cache.crc(ipath, st)
+        hashed = None
+        if settings.hash_resources and digest is None and ipath in self.stats:
+            if base is None or base.candidate(ipath, st.st_size) is None:
+                alg = hashlib.md5()
+                info, chunks = self.__compress_file(xpath, ipath, media_type, st, policy,
+                                                    hash_alg=alg)
+
+                # The checksum and the data come from the same read,
+                # so they always belong together.
+                digest = alg.hexdigest()
+                if blob_cache is not None and info.compress_type == Zip.ZIP_DEFLATED:
+                    level = policy.method(ipath, media_type, st.st_size)[1]
+                    blob_cache.put(digest, info.compress_type, level, info.CRC,
+                                   info.file_size, chunks)
+
+                return settings.normalize(info), chunks, None, (ipath, st, digest)
+
+            digest, crc = file_checksums(xpath)
+            hashed = (ipath, st, digest)
+
+        if base is not None:
+            base_info = base.match(ipath, xpath, st, digest, crc)
+            if base_info is not None and \
+               policy.accepts(ipath, media_type, st.st_size, base_info.compress_type):
+                info = kbundle.archive.copied_info(ipath, st, base_info)
+                return settings.normalize(info), None, base_info, hashed
+
+        # Looking up the blob cache requires choosing the compression
+        # type before reading the file. Otherwise, the first chunk read
+        # for compressing it is used to decide.
+        use_blob_cache = False
+        if blob_cache is not None and digest is not None:
+            compress_type, level = policy.choose(xpath, ipath, media_type, st.st_size)
+
+            # Stored data is no cheaper to read from the cache.
+            use_blob_cache = compress_type == Zip.ZIP_DEFLATED
+
+        if use_blob_cache:
+            cached = blob_cache.get(digest, compress_type, level, st.st_size)
+            if cached is not None:
+                crc, chunks = cached
+                info = kbundle.archive.precompressed_info(ipath, st, compress_type, crc,
+                                                          sum(map(len, chunks)), st.st_size)
+                return settings.normalize(info), chunks, None, hashed
+
+            info, chunks = self.__compress_file(xpath, ipath, media_type, st, policy,
+                                                compress_type, level)
+        else:
+            info, chunks = self.__compress_file(xpath, ipath, media_type, st, policy)
+
+        # Only cache the data if the file is known to still have the
+        # checksum it is cached under.
+        if use_blob_cache and (hashed is not None or self.stat_cache.matches(ipath, st)) and \
+           kbundle.cache.stat_key(os.stat(xpath)) == kbundle.cache.stat_key(st):
+            blob_cache.put(digest, compress_type, level, info.CRC, info.file_size, chunks)
+
+        return settings.normalize(info), chunks, None, hashed
+
+    def __compress_file(self, xpath, ipath, media_type, st, policy,
+                        compress_type=None, level=None, hash_alg=None):
+        """Compress a file, letting `policy` choose how from the first
+        chunk unless `compress_type` is given."""
+        choose = None
+        if compress_type is None:
+            choose = functools.partial(policy.choose, xpath, ipath, media_type, st.st_size)
+
+        cpu_time = time.thread_time()
+        info, chunks = kbundle.archive.compress_member(xpath, ipath, st, compress_type, level,
+                                                       hash_alg, choose)
+        if info.compress_type == Zip.ZIP_DEFLATED:
+            policy.record_deflate(info.file_size, time.thread_time() - cpu_time)
+
+        return info, chunks
+
+    def __fingerprint(self, checksums, policy, date_time):
+        """Compute a fingerprint of everything a reproducible archive is built from.
+
+        It covers the checksums of the resources and metadata files,
+        the compression rules and the timestamp. Raises OSError if a
+        metadata file can't be read.
+        """
+        alg = hashlib.md5()
+        alg.update(repr((FINGERPRINT_VERSION, policy.rules, tuple(date_time))).encode("utf-8"))
+        for ipath in sorted(checksums, key=kbundle.archive.archive_name):
+            alg.update("{}\0{}\n".format(kbundle.archive.archive_name(ipath),
+                                          checksums[ipath]).encode("utf-8"))
 
+        for ipath in ("preview.png", kbundle.manifest.MANIFEST_PATH, "meta.xml"):
+            alg.update("{}\0{}\n".format(ipath, md5sum(self.__external_path(ipath))).encode("utf-8"))
+
+        return alg.hexdigest()
+
+    def __cached_checksums(self, ipaths):
+        """Look up the checksums of several resources in the stat cache.
+
+        Returns a dictionary mapping the internal paths of the cached
+        resources to their checksums, or None if any of the files
+        isn't a regular file.
+        """
+        checksums = {}
+        for ipath in ipaths:
+            try:
+                st = self.__stat(ipath)
+            except OSError:
+                st = None
+
+            if st is None or not stat.S_ISREG(st.st_mode):
+                logger.error("Not a resource file: %s", self.__external_path(ipath))
+                return None
+
+            digest = self.stat_cache.lookup(ipath, st)
+            if digest is not None:
+                checksums[ipath] = digest
+
+        return checksums
+
+    def __apply_checksums(self, checksums):
+        """Bring the manifest entries in line with the scanned resources.
+
+        Entries are removed for resources which no longer exist, and
+        inserted or updated with the checksums in `checksums` for the
+        rest. The manifest isn't saved.
+        """
+        # common contains resources present in the manifest and on-disk.
+        # mf_only contains resources listed only in the manifest.
+        # file_only contains resources present on-disk, but not in the manifest.
+        common, mf_only, file_only = self.manifest.compare_entries(self.resources)
+
+        # Remove resources that exist in the manifest but not on disk
+        for ipath in sorted(mf_only):
+            self.__remove_entry(ipath, info="REMOVE")
+
+        # Each group is processed in sorted order so that the manifest
+        # is the same no matter which order the checksums finish in.
+        for ipath in sorted(file_only):
+            self.__insert_entry(ipath, checksums[ipath], info="INSERT")
+
+        for ipath in sorted(common):
+            self.__insert_entry(ipath, checksums[ipath], info="UPDATE")
+
+    def __remember_stat(self, ipath, st):
+        """Record (or forget, if `st` is None) the stat result of a resource file."""
+        if st is None:
+            self.stats.pop(ipath, None)
+        else:
+            self.stats[ipath] = st
+
+    def __stat(self, ipath):
+        """Return the stat result of a resource file from the last scan,
+        or from calling stat() if the scan didn't get one."""
+        st = self.stats.get(ipath)
+        return os.stat(self.__external_path(ipath)) if st is None else st
+
+    def __matching_entries(self, path):
+        """List the manifest entries matching a path or glob pattern."""
+        ipath = self.__internal_path(path)
+        if not glob.has_magic(ipath):
+            return [ipath] if self.manifest.has_entry(ipath) else []
+
+        return [entry_path for entry_path in self.manifest.entries
+                if fnmatch.fnmatchcase(entry_path, ipath)]
+
+    def __entries_under(self, ipath):
+        """List the manifest entries at or below an internal path."""
+        prefix = os.path.join(ipath, "")
+        return [path for path in self.manifest.entries
+                if path == ipath or path.startswith(prefix)]
+
+    def __save_stat_cache(self, prune=True):
+        """Save the stat cache and report how many files were hashed.
+
+        Unless `prune` is False, records for files which aren't
+        resources are dropped first.
+        """
+        if prune:
+            self.stat_cache.prune(self.resources)
+        try:
+            self.stat_cache.save()
+        except OSError as e:
+            logger.error("Failed to save checksum cache: %s", e)
+
+        logger.info(self.stat_cache.summary())
+
+    def __insert_entry(self, ipath, digest, info="INSERT"):
+        logger.info("%s: %s", info, ipath)
+        entry = self.__generate_entry(ipath, digest)
         self.manifest.insert_entry(entry)
-        return True
 
     def __remove_entry(self, ipath, info="REMOVE"):
-        print("{}: {}".format(info, ipath))
+        logger.info("%s: %s", info, ipath)
         return self.manifest.remove_entry(ipath)
@@ -0,0 +1,386 @@
+# Copyright 2023 Quytelda Kahja
+#
+# This file is part of kbundle.
+#
+# kbundle is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kbundle is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with kbundle. If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import os
+import os.path
+import struct
+import threading
+import time
+import zlib
+
+from kbundle.fileutil import atomic_write
+
+# Per-bundle cache files are kept in this directory under the bundle
+# root. It is a dotfile, so it is never scanned or packed.
+CACHE_DIR_NAME = ".kbundle-cache"
+
+STAT_CACHE_NAME    = "stat.json"
+STAT_CACHE_VERSION = 2
+
+# Files modified this recently (in nanoseconds) are not cached, since
+# a later write within the same timestamp granularity could change
+# the contents without changing the file status.
+RACY_WINDOW_NS = 2 * 10**9
+
+def stat_key(st):
+    """Return the part of a stat result used to detect file changes."""
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+class StatCache:
+    """A persistent map from resource paths to checksums.
+
+    Each record stores the size, modification time and inode number
+    of a file alongside its MD5 and CRC-32 checksums. Cached checksums
+    are only reused if all of these still match the file on disk.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        self.hits = 0
+        self.misses = 0
+
+    def load(self):
+        """Read the cache file.
+
+        A missing, unreadable, or outdated cache file is treated as
+        an empty cache. Returns False in that case, or True otherwise.
+        """
+        self.records = {}
+        self.hits = 0
+        self.misses = 0
+
+        try:
+            with open(self.path, "r", encoding="utf-8") as cache_file:
+                data = json.load(cache_file)
+        except (OSError, ValueError):
+            return False
+
+        if not isinstance(data, dict) or data.get("version") != STAT_CACHE_VERSION:
+            return False
+
+        records = data.get("records")
+        if not isinstance(records, dict):
+            return False
+
+        self.records = records
+        return True
+
+    def save(self):
+        """Write the cache file, creating the cache directory if needed."""
+        dir_path, _ = os.path.split(self.path)
+        os.makedirs(dir_path, exist_ok=True)
+
+        data = {"version": STAT_CACHE_VERSION, "records": self.records}
+        with atomic_write(self.path, "w") as cache_file:
+            json.dump(data, cache_file, separators=(',', ':'), sort_keys=True)
+
+    def lookup(self, ipath, st):
+        """Return the cached checksum for a file, or None on a cache miss."""
+        record = self.records.get(ipath)
+        if isinstance(record, list) and record[:3] == stat_key(st):
+            self.hits += 1
+            return record[3]
+
+        self.misses += 1
+        return None
+
+    def crc(self, ipath, st):
+        """Return the cached CRC-32 of a file, or None, without counting a hit or miss."""
+        record = self.records.get(ipath)
+        if isinstance(record, list) and len(record) > 4 and record[:3] == stat_key(st):
+            return record[4]
+
+        return None
+
+    def matches(self, ipath, st):
+        """Test whether the record for a file is still valid, without counting a hit or miss."""
+        record = self.records.get(ipath)
+        return isinstance(record, list) and record[:3] == stat_key(st)
+
+    def store(self, ipath, st, md5, crc):
+        """Record the checksums for a file.
+
+        `st` must be the stat result taken *before* the file was
+        hashed, so that concurrent modifications invalidate the record.
+        """
+        if time.time_ns() - st.st_mtime_ns < RACY_WINDOW_NS:
+            self.records.pop(ipath, None)
+            return
+
+        self.records[ipath] = stat_key(st) + [md5, crc]
+
+    def prune(self, ipaths):
+        """Forget records for all paths not in `ipaths`."""
+        keep = set(ipaths)
+        self.records = {ipath: record
+                        for ipath, record in self.records.items()
+                        if ipath in keep}
+
+    def forget(self, ipaths):
+        """Forget the records for some paths."""
+        for ipath in ipaths:
+            self.records.pop(ipath, None)
+
+    def clear(self):
+        """Forget all records."""
+        self.records = {}
+        self.hits = 0
+        self.misses = 0
+
+    def summary(self):
+        """Return a human-readable summary of cache usage."""
+        return "Checksum cache: {} hits, {} misses".format(self.hits, self.misses)
+
+PRESET_CACHE_NAME    = "presets.json"
+PRESET_CACHE_VERSION = 1
+
+class PresetCache:
+    """A persistent map from preset paths to preset metadata.
+
+    Each record is keyed by the MD5 checksum of the preset in the
+    manifest, so metadata is only extracted again for presets whose
+    manifest entry has changed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        self.changed = False
+
+    def load(self):
+        """Read the cache file, treating a bad or missing file as empty."""
+        self.records = {}
+        self.changed = False
+
+        try:
+            with open(self.path, "r", encoding="utf-8") as cache_file:
+                data = json.load(cache_file)
+        except (OSError, ValueError):
+            return False
+
+        if not isinstance(data, dict) or data.get("version") != PRESET_CACHE_VERSION:
+            return False
+
+        records = data.get("records")
+        if not isinstance(records, dict):
+            return False
+
+        self.records = records
+        return True
+
+    def save(self):
+        """Write the cache file if any records changed."""
+        if not self.changed:
+            return
+
+        dir_path, _ = os.path.split(self.path)
+        os.makedirs(dir_path, exist_ok=True)
+
+        data = {"version": PRESET_CACHE_VERSION, "records": self.records}
+        with atomic_write(self.path, "w") as cache_file:
+            json.dump(data, cache_file, separators=(',', ':'), sort_keys=True)
+
+        self.changed = False
+
+    def lookup(self, ipath, md5):
+        """Return the cached metadata for a preset, or None on a cache miss."""
+        record = self.records.get(ipath)
+        if isinstance(record, dict) and record.get("md5sum") == md5:
+            return record.get("metadata")
+
+        return None
+
+    def store(self, ipath, md5, metadata):
+        self.records[ipath] = {"md5sum": md5, "metadata": metadata}
+        self.changed = True
+
+    def prune(self, ipaths):
+        """Forget records for all paths not in `ipaths`."""
+        keep = set(ipaths)
+        if not keep.issuperset(self.records):
+            self.records = {ipath: record
+                            for ipath, record in self.records.items()
+                            if ipath in keep}
+            self.changed = True
+
+# Cached blobs start with this header: a magic number, the CRC-32 and
+# size of the uncompressed data, and the size and CRC-32 of the
+# compressed data.
+BLOB_HEADER = struct.Struct("<4sIQQI")
+BLOB_MAGIC  = b"KBB2"
+
+DEFAULT_BLOB_CACHE_SIZE = 1024**3
+
+# Temporary files older than this (in seconds) were left behind by an
+# interrupted process, and are removed during eviction.
+STALE_TEMP_AGE = 3600
+
+def default_blob_cache_dir():
+    """Return the per-user directory for the shared blob cache."""
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "kbundle", "blobs")
+
+def parse_size(text):
+    """Parse a size in bytes with an optional K, M, G or T suffix."""
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+    text = text.strip().upper().rstrip("B")
+    multiplier = 1
+    if text and text[-1] in units:
+        multiplier = units[text[-1]]
+        text = text[:-1]
+
+    size = int(float(text) * multiplier)
+    if size < 0:
+        raise ValueError("Size must not be negative: {}".format(text))
+
+    return size
+
+class BlobCache:
+    """A shared, content-addressed cache of compressed resource data.
+
+    Blobs are keyed by the MD5 checksum of the uncompressed data and
+    the compression settings, so they can be reused by any bundle on
+    the machine. The total size of the cache is kept below
+    `max_size` bytes by evicting the least recently used blobs.
+
+    Blobs are written atomically, and a blob which disappears is
+    simply treated as a cache miss, so several processes may use the
+    cache at once. Each blob records a CRC-32 of its compressed data,
+    and a damaged blob is treated as a miss and removed.
+    """
+
+    def __init__(self, path=None, max_size=DEFAULT_BLOB_CACHE_SIZE):
+        self.path = path or default_blob_cache_dir()
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.evicted = 0
+        self.lock = threading.Lock()
+
+    def blob_path(self, digest, compress_type, level):
+        name = "{}-{}-{}".format(digest, compress_type, level)
+        return os.path.join(self.path, digest[:2], name)
+
+    def get(self, digest, compress_type, level, file_size):
+        """Look up compressed data.
+
+        Returns a tuple of the CRC-32 of the uncompressed data and a
+        list of compressed data chunks, or None on a cache miss.
+        """
+        path = self.blob_path(digest, compress_type, level)
+        try:
+            with open(path, "rb") as blob_file:
+                header = blob_file.read(BLOB_HEADER.size)
+                data = blob_file.read()
+        except OSError:
+            self.__count("misses")
+            return None
+
+        try:
+            magic, crc, blob_file_size, compress_size, compress_crc = BLOB_HEADER.unpack(header)
+        except struct.error:
+            magic = None
+
+        if magic != BLOB_MAGIC or blob_file_size != file_size or \
+           compress_size != len(data) or compress_crc != zlib.crc32(data):
+            # A damaged blob would never become valid again.
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+            self.__count("misses")
+            return None
+
+        # Mark the blob as recently used.
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        self.__count("hits")
+        return crc, [data]
+
+    def put(self, digest, compress_type, level, crc, file_size, chunks):
+        """Store compressed data. Failures to write are ignored."""
+        path = self.blob_path(digest, compress_type, level)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            compress_crc = 0
+            for chunk in chunks:
+                compress_crc = zlib.crc32(chunk, compress_crc)
+
+            with atomic_write(path) as blob_file:
+                blob_file.write(BLOB_HEADER.pack(BLOB_MAGIC, crc, file_size,
+                                                 sum(map(len, chunks)), compress_crc))
+                for chunk in chunks:
+                    blob_file.write(chunk)
+        except OSError:
+            return
+
+        self.__count("stored")
+
+    def evict(self):
+        """Remove the least recently used blobs until the cache fits its size limit."""
+        blobs = []
+        total = 0
+        now = time.time()
+        for current_dir, _, files in os.walk(self.path):
+            for name in files:
+                path = os.path.join(current_dir, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+
+                if name.startswith("."):
+                    if now - st.st_mtime > STALE_TEMP_AGE:
+                        remove_quietly(path)
+                    continue
+
+                blobs.append((st.st_mtime_ns, st.st_size, path))
+                total += st.st_size
+
+        blobs.sort()
+        for _, size, path in blobs:
+            if total <= self.max_size:
+                break
+
+            if remove_quietly(path):
+                self.__count("evicted")
+            total -= size
+
+    def summary(self):
+        """Return a human-readable summary of cache usage."""
+        return "Blob cache: {} hits, {} misses, {} stored, {} evicted".format(
+            self.hits, self.misses, self.stored, self.evicted)
+
+    def __count(self, name):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+def remove_quietly(path):
+    """Remove a file which another process may have removed already."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        return False
+
+    return True
@@ -0,0 +1,189 @@
+# Copyright 2023 Quytelda Kahja
+#
+# This file is part of kbundle.
+#
+# kbundle is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kbundle is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with kbundle. If not, see <https://www.gnu.org/licenses/>.
+
+import os.path
+import threading
+import zipfile as Zip
+import zlib
+
+import kbundle.cache
+import kbundle.stats
+
+COMPRESSION_METHODS = ("store", "deflate", "auto")
+
+# Presets and patterns are PNG images, whose data is already
+# compressed, so they are only deflated if a sample shows it helps.
+# Rules given by the user are checked before these.
+DEFAULT_COMPRESSION_RULES = (".png=auto", ".kpp=auto", "*=deflate")
+
+# In "auto" mode, this many bytes from the start of a file are
+# compressed to estimate how well the whole file compresses.
+AUTO_SAMPLE_SIZE = 64 * 1024
+
+# Files are stored if compressing the sample saves less than this
+# fraction of its size.
+AUTO_MIN_SAVINGS = 0.05
+
+def parse_compression_rule(spec):
+    """Parse a compression rule of the form SELECTOR=METHOD.
+
+    SELECTOR is a file extension (".kpp"), a size threshold ("<4K" or
+    ">16M"), "*" for any file, or otherwise a media type (the name of
+    a resource directory, such as "patterns"). METHOD is "store",
+    "deflate" or "auto", optionally followed by ":LEVEL" to choose the
+    deflate level for "deflate" and "auto". Returns a tuple of the
+    selector kind, selector value, method and level. Raises
+    ValueError for malformed rules.
+    """
+    selector, sep, method = spec.partition("=")
+    selector = selector.strip()
+    if not sep or not selector:
+        raise ValueError("Compression rules must have the form SELECTOR=METHOD: {}".format(spec))
+
+    method, _, level = method.strip().partition(":")
+    if method not in COMPRESSION_METHODS:
+        raise ValueError("Unknown compression method: {}".format(method))
+
+    if not level:
+        level = zlib.Z_DEFAULT_COMPRESSION
+    elif method == "store":
+        raise ValueError("The store method has no compression level: {}".format(spec))
+    elif not level.isdigit() or not 0 <= int(level) <= 9:
+        raise ValueError("Compression levels must be between 0 and 9: {}".format(spec))
+    else:
+        level = int(level)
+
+    if selector == "*":
+        return "any", None, method, level
+    if selector.startswith("."):
+        return "extension", selector.lower(), method, level
+    if selector[0] in "<>":
+        return selector[0], kbundle.cache.parse_size(selector[1:]), method, level
+
+    return "media_type", selector, method, level
+
+class CompressionPolicy:
+    """Chooses how each member of a bundle archive is compressed.
+
+    Rules are checked in order and the first matching rule applies;
+    the default rules are checked after any given ones. The policy
+    also keeps track of how much compression was skipped, so that
+    the CPU time saved and the bytes gained can be reported.
+    """
+
+    def __init__(self, rules=()):
+        self.rules = [parse_compression_rule(spec)
+                      for spec in [*rules, *DEFAULT_COMPRESSION_RULES]]
+
+        self.lock = threading.Lock()
+        self.deflated_bytes = 0
+        self.deflate_time = 0.0
+        self.stored = 0
+        self.stored_bytes = 0
+        self.estimated_bytes = 0
+        self.estimated_gain = 0
+
+    def method(self, ipath, media_type, size):
+        """Return the method and level of the first rule matching a file."""
+        extension = os.path.splitext(ipath)[1].lower()
+        for kind, value, method, level in self.rules:
+            if kind == "any" or \
+               (kind == "extension" and extension == value) or \
+               (kind == "media_type" and media_type == value) or \
+               (kind == "<" and size < value) or \
+               (kind == ">" and size > value):
+                return method, level
+
+        return "deflate", zlib.Z_DEFAULT_COMPRESSION
+
+    def choose(self, xpath, ipath, media_type, size, sample=None):
+        """Return the compression type and level for a file.
+
+        In "auto" mode, the start of the file is read unless it is
+        passed as `sample` (which may be longer than needed).
+        """
+        method, level = self.method(ipath, media_type, size)
+        if method == "deflate":
+            return Zip.ZIP_DEFLATED, level
+        if method == "store":
+            self.__record_store(size, None)
+            return Zip.ZIP_STORED, zlib.Z_NO_COMPRESSION
+
+        if sample is None:
+            with open(xpath, "rb") as file:
+                sample = file.read(AUTO_SAMPLE_SIZE)
+            kbundle.stats.count("bytes_read", len(sample))
+        else:
+            sample = sample[:AUTO_SAMPLE_SIZE]
+
+        ratio = len(zlib.compress(sample, level)) / len(sample) if sample else 1.0
+        if ratio > 1 - AUTO_MIN_SAVINGS:
+            self.__record_store(size, size - int(size * ratio))
+            return Zip.ZIP_STORED, zlib.Z_NO_COMPRESSION
+
+        return Zip.ZIP_DEFLATED, level
+
+    def accepts(self, ipath, media_type, size, compress_type):
+        """Test whether an existing member may be reused as it is.
+
+        Files handled in "auto" mode are assumed to have been sampled
+        already when the member was written.
+        """
+        method, _ = self.method(ipath, media_type, size)
+        if method == "auto":
+            return compress_type in (Zip.ZIP_STORED, Zip.ZIP_DEFLATED)
+
+        return compress_type == (Zip.ZIP_STORED if method == "store" else Zip.ZIP_DEFLATED)
+
+    def record_deflate(self, size, cpu_time):
+        """Record the CPU time spent compressing a file."""
+        with self.lock:
+            self.deflated_bytes += size
+            self.deflate_time += cpu_time
+
+    def summary(self):
+        """Return a human-readable estimate of the effect of storing files.
+
+        The CPU time saved is estimated from the compression speed
+        measured for the deflated files. The change in size is only
+        known for files whose compressibility was sampled, and may be
+        negative for data which deflate would have made larger.
+        """
+        if not self.stored:
+            return None
+
+        text = "Compression: stored {} members ({} bytes) uncompressed".format(
+            self.stored, self.stored_bytes)
+        if self.deflated_bytes and self.deflate_time:
+            rate = self.deflated_bytes / self.deflate_time
+            text += ", saving about {:.2f}s of CPU time".format(self.stored_bytes / rate)
+
+        if self.estimated_bytes:
+            text += ", changing the archive size by about {:+d} bytes".format(self.estimated_gain)
+            if self.estimated_bytes < self.stored_bytes:
+                text += " (estimated for {} of {} bytes)".format(self.estimated_bytes,
+                                                                 self.stored_bytes)
+
+        return text + "."
+
+    def __record_store(self, size, gain):
+        with self.lock:
+            self.stored += 1
+            self.stored_bytes += size
+            if gain is not None:
+                self.estimated_bytes += size
+                self.estimated_gain += gain
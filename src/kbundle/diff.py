@@ -0,0 +1,207 @@
+# Copyright 2023 Quytelda Kahja
+#
+# This file is part of kbundle.
+#
+# kbundle is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kbundle is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with kbundle. If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import logging
+import os
+import os.path
+import zipfile as Zip
+
+import kbundle.archive
+import kbundle.bundle
+import kbundle.manifest
+import kbundle.stats
+
+logger = logging.getLogger(__name__)
+
+class Resource:
+    """What is known about a resource on one side of a diff.
+
+    For archives, the size and CRC-32 come from the ZIP central
+    directory and the checksum and tags from the embedded manifest.
+    For bundle trees, the checksums are only known up front if the
+    checksum cache has them; otherwise they are computed when needed.
+    """
+
+    def __init__(self, size, crc=None, md5=None, tags=(), xpath=None):
+        self.size = size
+        self.crc = crc
+        self.md5 = md5 or None
+        self.tags = set(tags)
+        self.xpath = xpath
+
+    def can_compute(self):
+        """Test whether checksums can be computed from a file on disk."""
+        return self.xpath is not None
+
+    def compute(self, kind):
+        if kind == "md5":
+            self.md5 = kbundle.bundle.md5sum(self.xpath)
+        else:
+            self.crc = kbundle.archive.crc32sum(self.xpath)
+
+def read_archive(path):
+    """Describe the resources in a bundle archive.
+
+    Only the central directory and the embedded manifest are read.
+    Returns a dictionary mapping member names to Resources.
+    """
+    with Zip.ZipFile(path, mode='r') as zip:
+        manifest = kbundle.manifest.Manifest(kbundle.manifest.MANIFEST_PATH)
+        try:
+            with zip.open(kbundle.manifest.MANIFEST_PATH) as manifest_file:
+                if not manifest.load(manifest_file):
+                    raise ValueError("Invalid manifest in {}".format(path))
+        except KeyError:
+            pass
+
+        entries = {kbundle.archive.archive_name(ipath): entry
+                   for ipath, entry in manifest.entries.items()}
+
+        resources = {}
+        for info in zip.infolist():
+            name = info.filename
+            if name not in entries and not kbundle.bundle.is_resource_path(name):
+                continue
+
+            entry = entries.get(name)
+            resources[name] = Resource(info.file_size, crc=info.CRC,
+                                       md5=entry.md5sum if entry else None,
+                                       tags=entry.tags if entry else ())
+
+    return resources
+
+def read_tree(root):
+    """Describe the resources in a bundle tree.
+
+    Checksums are taken from the checksum cache where it is still
+    valid for the file. Returns a dictionary mapping internal paths
+    (with '/' separators) to Resources.
+    """
+    bundle = kbundle.bundle.Bundle(root)
+    if not bundle.load():
+        raise ValueError("Failed to load bundle: {}".format(root))
+
+    bundle.stat_cache.load()
+
+    resources = {}
+    for ipath in bundle.resources:
+        xpath = os.path.join(root, ipath)
+        st = bundle.stats.get(ipath) or os.stat(xpath)
+        entry = bundle.manifest.entries.get(ipath)
+        md5 = bundle.stat_cache.lookup(ipath, st)
+        crc = bundle.stat_cache.crc(ipath, st)
+        resources[kbundle.archive.archive_name(ipath)] = Resource(st.st_size, crc=crc, md5=md5,
+                                                                  tags=entry.tags if entry else (),
+                                                                  xpath=xpath)
+
+    return resources
+
+def read_side(path):
+    """Describe a bundle archive, or a bundle tree if `path` is a directory."""
+    return read_tree(path) if os.path.isdir(path) else read_archive(path)
+
+def comparison_kind(old, new):
+    """Choose whether two resources are compared by MD5 or CRC-32.
+
+    The CRC-32 is used whenever either side has one and the other
+    side has or can compute one, since an archive member's CRC-32
+    comes from its data while its MD5 checksum comes from a manifest
+    which may be out of date. MD5 checksums are only used when
+    neither side has a CRC-32.
+    """
+    if (old.crc is not None and (new.crc is not None or new.can_compute())) or \
+       (new.crc is not None and old.can_compute()):
+        return "crc"
+
+    if (old.md5 or old.can_compute()) and (new.md5 or new.can_compute()):
+        return "md5"
+
+    return "crc"
+
+def diff(old_resources, new_resources, jobs=None):
+    """Compare two sets of resources.
+
+    Files in bundle trees are only hashed when the sizes match and no
+    cached checksum is available, using up to `jobs` worker threads.
+    Returns a dictionary with sorted lists of "added", "removed" and
+    "modified" paths, and a list of "retagged" resources describing
+    the tags added and removed.
+    """
+    common = sorted(old_resources.keys() & new_resources.keys())
+
+    pending = []
+    for name in common:
+        old, new = old_resources[name], new_resources[name]
+        if old.size != new.size:
+            continue
+
+        kind = comparison_kind(old, new)
+        for resource in (old, new):
+            if getattr(resource, kind) is None:
+                pending.append((resource, kind))
+
+    with kbundle.stats.phase("hash"):
+        kbundle.bundle.parallel_map(lambda task: task[0].compute(task[1]), pending, jobs)
+
+    modified = []
+    retagged = []
+    for name in common:
+        old, new = old_resources[name], new_resources[name]
+        kind = comparison_kind(old, new)
+        if old.size != new.size or getattr(old, kind) != getattr(new, kind):
+            modified.append(name)
+
+        if old.tags != new.tags:
+            retagged.append({"path"        : name,
+                             "added_tags"  : sorted(new.tags - old.tags),
+                             "removed_tags": sorted(old.tags - new.tags)})
+
+    return {"added"   : sorted(new_resources.keys() - old_resources.keys()),
+            "removed" : sorted(old_resources.keys() - new_resources.keys()),
+            "modified": modified,
+            "retagged": retagged}
+
+def print_diff(old_path, new_path, output_format="text", jobs=None):
+    """Print the differences between two bundle archives or trees.
+
+    The "text" format prints one line per change, starting with A
+    (added), D (removed), M (modified) or T (retagged), with fields
+    separated by tabs. The "json" format prints a single object.
+    """
+    try:
+        changes = diff(read_side(old_path), read_side(new_path), jobs)
+    except (OSError, ValueError, Zip.BadZipFile) as e:
+        logger.error("Failed to compare bundles: %s", e)
+        return False
+
+    if output_format == "json":
+        print(json.dumps(changes, indent=2))
+        return True
+
+    for name in changes["added"]:
+        print("A\t{}".format(name))
+    for name in changes["removed"]:
+        print("D\t{}".format(name))
+    for name in changes["modified"]:
+        print("M\t{}".format(name))
+    for change in changes["retagged"]:
+        tags = ["+" + tag for tag in change["added_tags"]] + \
+               ["-" + tag for tag in change["removed_tags"]]
+        print("\t".join(["T", change["path"]] + tags))
+
+    return True
@@ -0,0 +1,87 @@
+# Copyright 2023 Quytelda Kahja
+#
+# This file is part of kbundle.
+#
+# kbundle is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kbundle is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with kbundle. If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import os.path
+import secrets
+from contextlib import contextmanager
+
+# Temporary files are created with these flags, failing if the name is
+# already taken.
+TEMP_FILE_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0)
+
+def create_temp_file(dir_path, name):
+    """Create a new hidden temporary file next to `name` in `dir_path`.
+
+    The file is created with mode 0666, so the kernel applies the
+    umask just as it would for open(). Returns the file descriptor
+    and path of the new file.
+    """
+    while True:
+        tmp_path = os.path.join(dir_path, ".{}.{}.tmp".format(name, secrets.token_hex(4)))
+        try:
+            return os.open(tmp_path, TEMP_FILE_FLAGS, 0o666), tmp_path
+        except FileExistsError:
+            continue
+
+@contextmanager
+def atomic_write(path, mode="wb"):
+    """Open a temporary file which replaces the file at `path` on success.
+
+    The temporary file is created in the same directory as `path` so
+    that it can be renamed into place atomically. It gets the
+    permissions of the file it replaces, or otherwise the default
+    permissions of a new file. If the body of the `with` statement
+    raises an exception, the temporary file is removed and `path` is
+    left untouched.
+    """
+    dir_path, name = os.path.split(os.path.abspath(path))
+    fd, tmp_path = create_temp_file(dir_path, name)
+    try:
+        with os.fdopen(fd, mode) as file:
+            try:
+                os.chmod(tmp_path, os.stat(path).st_mode & 0o7777)
+            except FileNotFoundError:
+                pass
+
+            yield file
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+def file_matches(path, chunks):
+    """Test whether a file contains exactly the concatenation of `chunks`.
+
+    The file is compared incrementally, so neither its contents nor
+    the chunks are held in memory all at once. Returns False if the
+    file doesn't exist.
+    """
+    try:
+        file = open(path, "rb")
+    except FileNotFoundError:
+        return False
+
+    with file:
+        for chunk in chunks:
+            if file.read(len(chunk)) != chunk:
+                return False
+
+        return file.read(1) == b''
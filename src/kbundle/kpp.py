@@ -0,0 +1,198 @@
+# Copyright 2023 Quytelda Kahja
+#
+# This file is part of kbundle.
+#
+# kbundle is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kbundle is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with kbundle. If not, see <https://www.gnu.org/licenses/>.
+
+import os.path
+import re
+import struct
+import zlib
+import xml.etree.ElementTree as ET
+
+import kbundle.fileutil
+import kbundle.manifest
+
+PNG_MAGIC = b'\x89PNG\r\n\x1a\n'
+
+# The length and type at the start of each PNG chunk. The chunk data
+# follows, then a CRC-32 of the type and data.
+CHUNK_HEADER = struct.Struct(">I4s")
+CHUNK_CRC    = struct.Struct(">I")
+
+# Krita presets are PNG images with the preset settings stored as XML
+# in a compressed zTXt or iTXt chunk with the keyword "preset". These
+# are the start of the data of such a chunk, for each chunk type.
+PRESET_CHUNK_HEADERS = {
+    b'zTXt': b'preset\0\0',
+    b'iTXt': b'preset\0\1\0UTF-8\0preset\0',
+}
+
+PRESET_EXTENSION = ".kpp"
+
+# Chunk data which isn't edited is copied in pieces of this many bytes.
+COPY_CHUNK_SIZE = 1024 * 1024
+
+PRESET_NAME_PATTERN = re.compile(rb'(<Preset\b[^>]*?\sname=")([^"]*)(")')
+
+class PresetError(Exception):
+    """Raised for files which aren't valid presets."""
+
+def is_preset_path(path):
+    return os.path.splitext(path)[1].lower() == PRESET_EXTENSION
+
+def iter_chunks(file):
+    """Yield the type, data offset and data length of each PNG chunk.
+
+    The file position is left at the start of the chunk data, so the
+    caller may read it; the next chunk is found by its offset either
+    way, so the data is never read unless needed.
+    """
+    if file.read(len(PNG_MAGIC)) != PNG_MAGIC:
+        raise PresetError("Not a PNG file")
+
+    offset = len(PNG_MAGIC)
+    while True:
+        file.seek(offset)
+        header = file.read(CHUNK_HEADER.size)
+        if not header:
+            return
+        if len(header) < CHUNK_HEADER.size:
+            raise PresetError("Truncated PNG chunk header")
+
+        length, chunk_type = CHUNK_HEADER.unpack(header)
+        yield chunk_type, offset + CHUNK_HEADER.size, length
+        offset += CHUNK_HEADER.size + length + CHUNK_CRC.size
+
+def read_preset_chunk(file, chunk_type, length):
+    """Read and decompress preset settings from the current chunk.
+
+    Returns None if the chunk doesn't hold preset settings.
+    """
+    header = PRESET_CHUNK_HEADERS.get(chunk_type)
+    if header is None or length < len(header) or file.read(len(header)) != header:
+        return None
+
+    try:
+        return zlib.decompress(file.read(length - len(header)))
+    except zlib.error as e:
+        raise PresetError("Damaged preset settings: {}".format(e))
+
+def find_preset_settings(file):
+    """Return the type, data offset, data length and XML text of the
+    preset settings chunk. Image data is skipped without reading it."""
+    for chunk_type, offset, length in iter_chunks(file):
+        text = read_preset_chunk(file, chunk_type, length)
+        if text is not None:
+            return chunk_type, offset, length, text
+
+    raise PresetError("Found no preset settings chunk")
+
+def read_preset_metadata(path):
+    """Read the name, paintop and resource references of a preset.
+
+    Returns a dictionary with the keys "name", "paintop" and
+    "resources", the last being a list of dictionaries describing the
+    resources (such as brush tips and patterns) the preset uses. Raises
+    PresetError for files which aren't valid presets, or OSError.
+    """
+    with open(path, "rb") as file:
+        _, _, _, text = find_preset_settings(file)
+
+    try:
+        root = ET.fromstring(text)
+    except ET.ParseError as e:
+        raise PresetError("Damaged preset settings: {}".format(e))
+
+    if root.tag != "Preset":
+        raise PresetError("Preset settings have no Preset element")
+
+    resources = [{key: element.get(key, "") for key in ("type", "filename", "name", "md5sum")}
+                 for element in root.iterfind("resources/resource")]
+
+    return {"name"     : root.get("name", ""),
+            "paintop"  : root.get("paintopid", ""),
+            "resources": resources}
+
+def default_preset_name(path):
+    """Derive a preset name from its file name, as Krita does."""
+    filename, _ = os.path.splitext(os.path.basename(path))
+    return filename.replace('_', ' ')
+
+def rename_preset(path, new_name=None):
+    """Change the name stored in a preset file.
+
+    If no name is given, it is derived from the file name. The file is
+    rewritten chunk by chunk to a temporary file which then replaces
+    the original, so only the settings chunk is ever held in memory
+    and an interrupted rename leaves the original intact. Nothing is
+    written if the name doesn't change.
+
+    Returns a tuple of the old and new names. Raises PresetError for
+    files which aren't valid presets, or OSError.
+    """
+    if new_name is None:
+        new_name = default_preset_name(path)
+
+    with open(path, "rb") as file:
+        chunk_type, offset, length, text = find_preset_settings(file)
+
+        try:
+            root = ET.fromstring(text)
+        except ET.ParseError as e:
+            raise PresetError("Damaged preset settings: {}".format(e))
+
+        old_name = root.get("name")
+        if root.tag != "Preset" or old_name is None:
+            raise PresetError("Preset settings have no name")
+
+        if old_name == new_name:
+            return old_name, new_name
+
+        # The XML is edited as text, so everything else in it stays
+        # exactly as Krita wrote it.
+        escaped = kbundle.manifest.escape_xml(new_name).encode("utf-8")
+        text, replaced = PRESET_NAME_PATTERN.subn(lambda match: match[1] + escaped + match[3],
+                                                  text, count=1)
+        if not replaced:
+            raise PresetError("Preset settings have no name")
+
+        header = PRESET_CHUNK_HEADERS[chunk_type]
+        data = header + zlib.compress(text)
+        chunk_start = offset - CHUNK_HEADER.size
+        chunk_end = offset + length + CHUNK_CRC.size
+
+        with kbundle.fileutil.atomic_write(path) as output:
+            file.seek(0)
+            copy_bytes(file, output, chunk_start)
+
+            output.write(CHUNK_HEADER.pack(len(data), chunk_type))
+            output.write(data)
+            output.write(CHUNK_CRC.pack(zlib.crc32(chunk_type + data)))
+
+            file.seek(chunk_end)
+            for chunk in iter(lambda: file.read(COPY_CHUNK_SIZE), b''):
+                output.write(chunk)
+
+    return old_name, new_name
+
+def copy_bytes(source, destination, size):
+    """Copy `size` bytes from one file to another in bounded pieces."""
+    while size > 0:
+        chunk = source.read(min(size, COPY_CHUNK_SIZE))
+        if not chunk:
+            raise PresetError("Unexpected end of file")
+
+        destination.write(chunk)
+        size -= len(chunk)
@@ -15,11 +15,19 @@
 # You should have received a copy of the GNU General Public License
 # along with kbundle. If not, see <https://www.gnu.org/licenses/>.
 
+import logging
 import os.path
+import sys
 import xml.dom.minidom as MD
+import xml.etree.ElementTree as ET
 import pprint
 from dataclasses import dataclass
 
+import kbundle.stats
+from kbundle.fileutil import atomic_write, file_matches
+
+logger = logging.getLogger(__name__)
+
 MANIFEST_PATH   = "META-INF/manifest.xml"
 MANIFEST_XMLNS  = "urn:oasis:names:tc:opendocument:xmlns:manifest:1.0"
 
@@ -33,17 +41,68 @@ ATTR_MEDIA_TYPE = "manifest:media-type"
 ATTR_FULL_PATH  = "manifest:full-path"
 ATTR_MD5SUM     = "manifest:md5sum"
 
+def escape_xml(data):
+    """Escape special characters in XML text or attribute values.
+
+    This escapes the same characters as xml.dom.minidom does.
+    """
+    return data.replace("&", "&amp;").replace("<", "&lt;") \
+               .replace("\"", "&quot;").replace(">", "&gt;")
+
+def qualified_name(name):
+    """Convert a prefixed XML name into the form used by ElementTree.
+
+    For example, "manifest:tags" becomes "{<MANIFEST_XMLNS>}tags".
+    """
+    _, local_name = name.split(":", 1)
+    return "{{{}}}{}".format(MANIFEST_XMLNS, local_name)
+
+# XML Node Names (ElementTree)
+QNAME_MANIFEST   = qualified_name(ELEM_MANIFEST  )
+QNAME_FILE_ENTRY = qualified_name(ELEM_FILE_ENTRY)
+QNAME_TAGS       = qualified_name(ELEM_TAGS      )
+QNAME_TAG        = qualified_name(ELEM_TAG       )
+QNAME_VERSION    = qualified_name(ATTR_VERSION   )
+QNAME_MEDIA_TYPE = qualified_name(ATTR_MEDIA_TYPE)
+QNAME_FULL_PATH  = qualified_name(ATTR_FULL_PATH )
+QNAME_MD5SUM     = qualified_name(ATTR_MD5SUM    )
+
+def discard_indexed(index, key, path):
+    """Remove a path from an inverted index, dropping empty keys."""
+    paths = index.get(key)
+    if paths is None:
+        return
+
+    paths.discard(path)
+    if not paths:
+        del index[key]
+
+def unique_tags(tags):
+    """Return a tuple of interned tags, without duplicates, in their original order."""
+    return tuple(dict.fromkeys(map(sys.intern, tags)))
+
 @dataclass
 class ManifestEntry:
-    """ManifestEntry is a class which represents an entry in the manifest."""
+    """ManifestEntry is a class which represents an entry in the manifest.
+
+    Manifests can have hundreds of thousands of entries, so entries
+    have no instance dictionary, media types and tags are interned,
+    and tags are kept in a tuple without duplicates.
+    """
+
+    __slots__ = ("full_path", "media_type", "md5sum", "tags")
 
     full_path: str
     media_type: str
     md5sum: str
-    tags: list[str]
+    tags: tuple[str, ...]
+
+    def __post_init__(self):
+        self.media_type = sys.intern(self.media_type)
+        self.tags = unique_tags(self.tags) if self.tags else ()
 
     def to_string(self):
-        tag_list = pprint.pformat(self.tags)
+        tag_list = pprint.pformat(list(self.tags))
         return '\n'.join([self.full_path,
                           "\tmedia-type: {}".format(self.media_type),
                           "\tmd5sum: {}".format(self.md5sum),
@@ -56,34 +115,68 @@ class Manifest:
         self.path = manifestPath
         self.entries = {}
 
+        # Inverted indexes mapping each tag and media type to the set
+        # of paths of the entries which have it. These are kept up to
+        # date by the methods which modify entries.
+        self.tag_index = {}
+        self.type_index = {}
+
     def exists(self):
         """Test whether the backing manifest XML file exists."""
         return os.path.isfile(self.path)
 
-    def load(self):
-        """Read and parse the manifest XML file."""
+    def load(self, file=None):
+        """Read and parse the manifest XML file.
 
-        doc = MD.parse(self.path)
-        root = doc.documentElement
-        if root.tagName != ELEM_MANIFEST or root.getAttribute(ATTR_VERSION) != "1.2":
-            return False;
+        If a binary file object is given, the manifest is read from
+        it instead of the backing manifest file. The document is
+        parsed incrementally and each file-entry element is discarded
+        once it has been converted into a ManifestEntry, so the whole
+        document is never held in memory.
+        """
+        with kbundle.stats.phase("manifest_load"):
+            return self.__parse(file)
 
+    def __parse(self, file):
         self.entries = {}
-        for e in doc.getElementsByTagName(ELEM_FILE_ENTRY):
-            entry = self.__entry_from_xml(e)
-            if entry is None:
+        self.tag_index = {}
+        self.type_index = {}
+
+        try:
+            events = ET.iterparse(self.path if file is None else file,
+                                  events=("start", "end"))
+
+            _, root = next(events)
+            if root.tag != QNAME_MANIFEST or root.get(QNAME_VERSION) != "1.2":
                 return False
 
-            # Skip entry for bundle root that is always present.
-            if entry.full_path == "/" or entry.full_path == "\\":
-                continue
+            for event, elem in events:
+                if event != "end" or elem.tag != QNAME_FILE_ENTRY:
+                    continue
+
+                entry = self.__entry_from_xml(elem)
+                root.clear()
 
-            self.insert_entry(entry)
+                # Skip entry for bundle root that is always present.
+                if entry.full_path == "/" or entry.full_path == "\\":
+                    continue
+
+                self.insert_entry(entry)
+        except ET.ParseError as e:
+            logger.error("Malformed manifest: %s", e)
+            return False
 
         return True
 
     def save(self):
-        """Write this manifest to the manifest XML file."""
+        """Write this manifest to the manifest XML file.
+
+        The XML is streamed into a temporary file which then replaces
+        the manifest file atomically. If the manifest file already
+        has exactly the same contents, it isn't written at all, so
+        its modification time is preserved. Returns True if the file
+        was written, or False if it was already up to date.
+        """
 
         # If the "META-INF" directory doesn't exists, create it.
         # The manifest file is created when written.
@@ -91,21 +184,32 @@ class Manifest:
         if not os.path.isdir(dir_path):
             os.mkdir(dir_path)
 
-        doc = self.to_xml()
-        output = doc.toprettyxml(indent=' ', encoding='UTF-8')
+        with kbundle.stats.phase("manifest_save"):
+            if file_matches(self.path, self.iter_xml()):
+                return False
+
+            with atomic_write(self.path) as manifest_file:
+                for chunk in self.iter_xml():
+                    manifest_file.write(chunk)
 
-        with open(self.path, "wb") as manifest_file:
-            manifest_file.write(output)
+        return True
 
     def insert_entry(self, entry):
         """Add a new ManifestEntry to the manifest."""
 
         # If an entry already exists for the provided path, replace
-        # it, but merge the old and new tag lists.
-        if entry.full_path in self.entries:
-            entry.tags += self.entries[entry.full_path].tags
+        # it, but merge the old and new tags. The merged tags include
+        # all of the old ones, so only the media type may need to be
+        # removed from the indexes.
+        old_entry = self.entries.get(entry.full_path)
+        if old_entry is not None:
+            if old_entry.tags:
+                entry.tags = tuple(dict.fromkeys(entry.tags + old_entry.tags))
+            if old_entry.media_type != entry.media_type:
+                discard_indexed(self.type_index, old_entry.media_type, entry.full_path)
 
         self.entries[entry.full_path] = entry
+        self.__index_entry(entry)
 
     def remove_entry(self, path):
         """Remove the entry with the given path from the manifest.
@@ -116,7 +220,7 @@ class Manifest:
         if path not in self.entries:
             return False
 
-        del self.entries[path]
+        self.__unindex_entry(self.entries.pop(path))
         return True
 
     def has_entry(self, path):
@@ -138,9 +242,9 @@ class Manifest:
         return (common, only_here, only_there)
 
     def tags(self, path):
-        """Return the list of tags for the resource at the given path.
+        """Return the tuple of tags for the resource at the given path.
 
-        If no entry exists for the given path, an empty list is returned.
+        If no entry exists for the given path, None is returned.
         """
         if not self.has_entry(path):
             return None
@@ -156,10 +260,13 @@ class Manifest:
         if not self.has_entry(path):
             return False
 
-        if tag in self.entries[path].tags:
+        entry = self.entries[path]
+        if tag in entry.tags:
             return False
 
-        self.entries[path].tags.append(tag)
+        tag = sys.intern(tag)
+        entry.tags += (tag,)
+        self.tag_index.setdefault(tag, set()).add(path)
         return True
 
     def remove_tag(self, path, tag):
@@ -171,12 +278,46 @@ class Manifest:
         if not self.has_entry(path):
             return False
 
-        if tag not in self.entries[path].tags:
+        entry = self.entries[path]
+        if tag not in entry.tags:
             return False
 
-        self.entries[path].tags.remove(tag)
+        tags = list(entry.tags)
+        tags.remove(tag)
+        entry.tags = tuple(tags)
+        discard_indexed(self.tag_index, tag, path)
+
         return True
 
+    def query(self, tags=(), media_type=None, prefix=None, untagged=False):
+        """Find the entries matching all of the given criteria.
+
+        Entries must have every tag in `tags`, the media type
+        `media_type` (if given), a path starting with the directory
+        `prefix` (if given), and no tags at all if `untagged` is True.
+        Returns a sorted list of entry paths.
+        """
+        candidates = [self.tag_index.get(tag, set()) for tag in tags]
+        if media_type is not None:
+            candidates.append(self.type_index.get(media_type, set()))
+
+        if candidates:
+            candidates.sort(key=len)
+            paths = set(candidates[0]).intersection(*candidates[1:])
+        else:
+            paths = self.entries.keys()
+
+        if prefix is not None:
+            prefix = os.path.normpath(prefix)
+            prefix_dir = os.path.join(prefix, "")
+            paths = [path for path in paths
+                     if path == prefix or path.startswith(prefix_dir)]
+
+        if untagged:
+            paths = [path for path in paths if not self.entries[path].tags]
+
+        return sorted(paths)
+
     def to_xml(self):
         """Generate an XML document which describes the manifest."""
         doc = MD.getDOMImplementation().createDocument(MANIFEST_XMLNS, ELEM_MANIFEST, None)
@@ -197,31 +338,65 @@ class Manifest:
 
         return doc
 
+    def iter_xml(self):
+        """Serialize the manifest as XML, yielding UTF-8 encoded chunks.
+
+        The output is identical to that of
+        `to_xml().toprettyxml(indent=' ', encoding='UTF-8')`, but it
+        is generated one entry at a time without building a DOM.
+        """
+        yield '<?xml version="1.0" encoding="UTF-8"?>\n'.encode()
+        yield '<{} xmlns:manifest="{}" {}="1.2">\n'.format(ELEM_MANIFEST,
+                                                           escape_xml(MANIFEST_XMLNS),
+                                                           ATTR_VERSION).encode()
+
+        # A file-entry for the bundle's root directory is always included.
+        yield ' <{} {}="application/x-krita-resourcebundle" {}="/"/>\n'.format(
+            ELEM_FILE_ENTRY, ATTR_MEDIA_TYPE, ATTR_FULL_PATH).encode()
+
+        for entry in self.entries.values():
+            yield self.__entry_to_string(entry).encode("utf-8", "xmlcharrefreplace")
+
+        yield '</{}>\n'.format(ELEM_MANIFEST).encode()
+
     def to_string(self):
         """Generate a human-readable string representation of the manifest."""
         return '\n\n'.join([entry.to_string() for entry in self.entries.values()])
 
+    def __index_entry(self, entry):
+        """Add an entry to the tag and media type indexes."""
+        for tag in entry.tags:
+            self.tag_index.setdefault(tag, set()).add(entry.full_path)
+
+        self.type_index.setdefault(entry.media_type, set()).add(entry.full_path)
+
+    def __unindex_entry(self, entry):
+        """Remove an entry from the tag and media type indexes."""
+        for tag in entry.tags:
+            discard_indexed(self.tag_index, tag, entry.full_path)
+
+        discard_indexed(self.type_index, entry.media_type, entry.full_path)
+
     def __tags_from_xml(self, e):
-        """Parse a list of tags from an appropriate XML DOM element."""
+        """Parse a list of tags from an appropriate XML element."""
         tags = []
-        for tags_elem in e.getElementsByTagName(ELEM_TAGS):
-            for tag_elem in tags_elem.getElementsByTagName(ELEM_TAG):
-                tags.append(tag_elem.firstChild.data)
+        for tags_elem in e.iter(QNAME_TAGS):
+            for tag_elem in tags_elem.iter(QNAME_TAG):
+                if tag_elem.text:
+                    tags.append(tag_elem.text)
 
         return tags
 
     def __entry_from_xml(self, e):
-        """Parse a ManifestEntry from an equivalent XML DOM element."""
-        if e.tagName != ELEM_FILE_ENTRY:
-            return None
+        """Parse a ManifestEntry from an equivalent XML element."""
 
         # Resource paths in the manifest must use forward slash (/)
         # separators, so we must convert them into the local style.
-        fixed_path = os.path.normpath(e.getAttribute(ATTR_FULL_PATH))
+        fixed_path = os.path.normpath(e.get(QNAME_FULL_PATH, ""))
 
         entry = ManifestEntry(full_path  = fixed_path,
-                              media_type = e.getAttribute(ATTR_MEDIA_TYPE),
-                              md5sum     = e.getAttribute(ATTR_MD5SUM    ),
+                              media_type = e.get(QNAME_MEDIA_TYPE, ""),
+                              md5sum     = e.get(QNAME_MD5SUM    , ""),
                               tags       = self.__tags_from_xml(e))
         return entry
 
@@ -238,6 +413,27 @@ class Manifest:
 
         return tags_elem
 
+    def __entry_to_string(self, entry):
+        """Convert a ManifestEntry into an indented XML string."""
+
+        # Resource paths in the manifest must use forward slash (/)
+        # separators, so Windows-style paths need to be fixed.
+        fixed_path = entry.full_path.replace("\\", "/")
+
+        start_tag = ' <{} {}="{}" {}="{}" {}="{}"'.format(ELEM_FILE_ENTRY,
+                                                          ATTR_MEDIA_TYPE, escape_xml(entry.media_type),
+                                                          ATTR_FULL_PATH , escape_xml(fixed_path      ),
+                                                          ATTR_MD5SUM    , escape_xml(entry.md5sum    ))
+        if not entry.tags:
+            return start_tag + "/>\n"
+
+        lines = [start_tag + ">", "  <{}>".format(ELEM_TAGS)]
+        for tag in entry.tags:
+            lines.append("   <{0}>{1}</{0}>".format(ELEM_TAG, escape_xml(tag)))
+        lines += ["  </{}>".format(ELEM_TAGS), " </{}>".format(ELEM_FILE_ENTRY), ""]
+
+        return "\n".join(lines)
+
     def __entry_to_xml(self, doc, entry):
         """Convert a ManifestEntry into an equivalent XML DOM element."""
         entry_elem = doc.createElement(ELEM_FILE_ENTRY)
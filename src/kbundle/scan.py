@@ -0,0 +1,154 @@
+# Copyright 2023 Quytelda Kahja
+#
+# This file is part of kbundle.
+#
+# kbundle is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kbundle is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with kbundle. If not, see <https://www.gnu.org/licenses/>.
+
+import fnmatch
+import os
+import os.path
+import re
+
+import kbundle.stats
+
+# Patterns for files which don't belong in the bundle are read from
+# this file in the bundle root.
+IGNORE_FILE_NAME = ".kbundleignore"
+
+def parse_ignore_patterns(lines):
+    """Read ignore patterns from an iterable of strings.
+
+    Blank lines and lines starting with '#' are skipped.
+    """
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith("#"):
+            yield line
+
+def compile_patterns(patterns):
+    """Combine several glob patterns into one regular expression, or None."""
+    if not patterns:
+        return None
+
+    return re.compile("|".join(map(fnmatch.translate, patterns)))
+
+class IgnoreRules:
+    """Patterns naming files and directories to leave out of a bundle.
+
+    Patterns containing a '/' are matched against the whole path from
+    the bundle root (such as "brushes/*.psd"), and other patterns
+    against the file or directory name alone (such as "*~"). Patterns
+    ending in '/' only match directories, whose contents are then
+    skipped without being listed.
+    """
+
+    def __init__(self, patterns=()):
+        groups = {(False, False): [], (False, True): [], (True, False): [], (True, True): []}
+        for pattern in patterns:
+            dirs_only = pattern.endswith("/")
+            pattern = pattern.strip("/")
+            if pattern:
+                groups["/" in pattern, dirs_only].append(pattern)
+
+        self.name_any  = compile_patterns(groups[False, False])
+        self.name_dirs = compile_patterns(groups[False, True ])
+        self.path_any  = compile_patterns(groups[True , False])
+        self.path_dirs = compile_patterns(groups[True , True ])
+
+    @classmethod
+    def load(cls, root):
+        """Read the ignore file of a bundle tree, if it has one.
+
+        Raises OSError if the file exists but can't be read.
+        """
+        try:
+            with open(os.path.join(root, IGNORE_FILE_NAME), "r", encoding="utf-8") as ignore_file:
+                return cls(parse_ignore_patterns(ignore_file))
+        except FileNotFoundError:
+            return cls()
+
+    def ignores(self, ipath, is_dir=False):
+        """Test whether a file or directory matches an ignore pattern.
+
+        Only the path itself is checked, not the directories above it.
+        """
+        name = os.path.basename(ipath)
+        path = ipath.replace(os.sep, "/")
+        for pattern, subject, applies in ((self.name_any , name, True  ),
+                                          (self.name_dirs, name, is_dir),
+                                          (self.path_any , path, True  ),
+                                          (self.path_dirs, path, is_dir)):
+            if applies and pattern is not None and pattern.match(subject):
+                return True
+
+        return False
+
+    def ignores_path(self, ipath):
+        """Test whether a file, or any directory containing it, is ignored."""
+        parent = os.path.dirname(ipath)
+        while parent:
+            if self.ignores(parent, is_dir=True):
+                return True
+            parent = os.path.dirname(parent)
+
+        return self.ignores(ipath)
+
+def scan_tree(root, dir_ipaths, rules=None):
+    """Find the files in some directories of a bundle tree.
+
+    Each directory in `dir_ipaths` is given relative to `root` and is
+    searched recursively with os.scandir(). Hidden files and
+    directories, and those matched by the IgnoreRules `rules`, are
+    skipped. Symbolic links to directories aren't followed. Yields
+    the internal path and stat result of each file, or None instead
+    of the stat result if the file can't be stat()ed.
+    """
+    pending = [dir_ipath for dir_ipath in reversed(dir_ipaths)
+               if rules is None or not rules.ignores(dir_ipath, is_dir=True)]
+    while pending:
+        dir_ipath = pending.pop()
+        try:
+            entries = os.scandir(os.path.join(root, dir_ipath))
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+
+        subdirs = []
+        with entries:
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+
+                ipath = os.path.join(dir_ipath, entry.name)
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+
+                if rules is not None and rules.ignores(ipath, is_dir):
+                    kbundle.stats.count("files_ignored")
+                    continue
+
+                if is_dir:
+                    if not entry.is_symlink():
+                        subdirs.append(ipath)
+                    continue
+
+                try:
+                    st = entry.stat()
+                except OSError:
+                    st = None
+
+                yield ipath, st
+
+        pending += reversed(subdirs)
@@ -0,0 +1,98 @@
+# Copyright 2023 Quytelda Kahja
+#
+# This file is part of kbundle.
+#
+# kbundle is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kbundle is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with kbundle. If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+class Stats:
+    """Timing and counter measurements for the phases of a command.
+
+    Each phase accumulates wall-clock time, process CPU time (which
+    includes worker threads) and the number of times it was entered.
+    Counters are plain named totals, such as the number of bytes
+    hashed. Both may be updated from several threads at once.
+    """
+
+    def __init__(self):
+        self.phases = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        """Measure the time spent in the body of a `with` statement."""
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+            with self.lock:
+                totals = self.phases.setdefault(name, {"wall": 0.0, "cpu": 0.0, "calls": 0})
+                totals["wall"] += wall
+                totals["cpu"] += cpu
+                totals["calls"] += 1
+
+    def count(self, name, amount=1):
+        """Add to the named counter."""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def clear(self):
+        with self.lock:
+            self.phases = {}
+            self.counters = {}
+
+    def to_dict(self):
+        with self.lock:
+            return {"phases"  : {name: dict(totals) for name, totals in self.phases.items()},
+                    "counters": dict(self.counters)}
+
+    def to_string(self):
+        """Generate a human-readable table of the measurements."""
+        data = self.to_dict()
+        lines = ["{:<20} {:>10} {:>10} {:>7}".format("phase", "wall (s)", "cpu (s)", "calls")]
+        for name, totals in data["phases"].items():
+            lines.append("{:<20} {:>10.3f} {:>10.3f} {:>7}".format(name, totals["wall"],
+                                                                 totals["cpu"], totals["calls"]))
+
+        if data["counters"]:
+            lines.append("")
+            for name, value in sorted(data["counters"].items()):
+                lines.append("{:<20} {:>10}".format(name, value))
+
+        return '\n'.join(lines)
+
+    def save(self, path):
+        """Write the measurements to a file as JSON."""
+        with open(path, "w") as stats_file:
+            json.dump(self.to_dict(), stats_file, indent=2)
+            stats_file.write("\n")
+
+# Measurements for the current process.
+STATS = Stats()
+
+def phase(name):
+    """Measure a phase of the current command. See Stats.phase()."""
+    return STATS.phase(name)
+
+def count(name, amount=1):
+    """Add to a counter for the current command. See Stats.count()."""
+    STATS.count(name, amount)
@@ -0,0 +1,154 @@
+# Copyright 2023 Quytelda Kahja
+#
+# This file is part of kbundle.
+#
+# kbundle is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kbundle is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with kbundle. If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+import zipfile as Zip
+import zlib
+
+import kbundle.archive
+import kbundle.bundle
+import kbundle.manifest
+import kbundle.stats
+
+# Members every bundle archive has besides its resources. They aren't
+# listed in the manifest.
+METADATA_MEMBERS = ("mimetype", kbundle.manifest.MANIFEST_PATH, "meta.xml", "preview.png")
+
+# Reading a damaged member can raise any of these. Unsupported
+# compression methods raise NotImplementedError, and encrypted
+# members RuntimeError.
+MEMBER_ERRORS = (Zip.BadZipFile, zlib.error, EOFError, NotImplementedError, RuntimeError, OSError)
+
+def member_md5sum(zip, info):
+    """Return the MD5 checksum of an archive member's uncompressed data.
+
+    The data is decompressed in chunks, and its CRC-32 is checked
+    against the archive directory along the way.
+    """
+    alg = hashlib.md5()
+    with zip.open(info) as member:
+        for chunk in iter(lambda: member.read(kbundle.bundle.HASH_CHUNK_SIZE), b''):
+            alg.update(chunk)
+            kbundle.stats.count("bytes_verified", len(chunk))
+
+    return alg.hexdigest()
+
+def check_mimetype(zip):
+    """Return a description of what is wrong with the mimetype member, or None."""
+    infos = zip.infolist()
+    if not infos or infos[0].filename != "mimetype":
+        return "mimetype is not the first member"
+
+    info = infos[0]
+    if info.compress_type != Zip.ZIP_STORED:
+        return "mimetype is compressed"
+
+    try:
+        data = zip.read(info)
+    except MEMBER_ERRORS as e:
+        return "mimetype can't be read: {}".format(e)
+
+    if data != kbundle.bundle.BUNDLE_MIMETYPE:
+        return "mimetype has the wrong contents"
+
+    return None
+
+def verify_archive(path, jobs=None):
+    """Check that a bundle archive matches its embedded manifest.
+
+    Every resource listed in the manifest is decompressed in memory
+    and its MD5 checksum compared with the manifest, using up to
+    `jobs` worker threads. Nothing is written to disk. Returns the
+    number of members checked and a list of (kind, member, detail)
+    tuples describing each problem found, where the kind is one of
+    "ERROR", "MIMETYPE", "MISSING", "EXTRA", "MISMATCH" or "CORRUPT".
+    """
+    problems = []
+    try:
+        archive = Zip.ZipFile(path, mode='r')
+    except (OSError, Zip.BadZipFile) as e:
+        return 0, [("ERROR", path, str(e))]
+
+    with archive as zip:
+        problem = check_mimetype(zip)
+        if problem is not None:
+            problems.append(("MIMETYPE", "mimetype", problem))
+
+        manifest = kbundle.manifest.Manifest(kbundle.manifest.MANIFEST_PATH)
+        try:
+            with zip.open(kbundle.manifest.MANIFEST_PATH) as manifest_file:
+                if not manifest.load(manifest_file):
+                    problems.append(("ERROR", kbundle.manifest.MANIFEST_PATH, "invalid manifest"))
+                    return 0, problems
+        except KeyError:
+            problems.append(("MISSING", kbundle.manifest.MANIFEST_PATH, "no manifest"))
+            return 0, problems
+        except MEMBER_ERRORS as e:
+            problems.append(("CORRUPT", kbundle.manifest.MANIFEST_PATH, str(e)))
+            return 0, problems
+
+        members = {kbundle.archive.archive_name(ipath): entry.md5sum
+                   for ipath, entry in manifest.entries.items()}
+
+        for name in sorted(zip.NameToInfo.keys() - members.keys() - set(METADATA_MEMBERS)):
+            if not name.endswith("/"):
+                problems.append(("EXTRA", name, "not in manifest"))
+
+        present = []
+        for name in sorted(members):
+            if name in zip.NameToInfo:
+                present.append(name)
+            else:
+                problems.append(("MISSING", name, "listed in manifest"))
+
+        def check(name):
+            try:
+                digest = member_md5sum(zip, zip.getinfo(name))
+            except MEMBER_ERRORS as e:
+                return "CORRUPT", name, str(e)
+
+            if members[name] and digest != members[name]:
+                return "MISMATCH", name, "md5sum {}, manifest has {}".format(digest, members[name])
+
+            return None
+
+        with kbundle.stats.phase("verify"):
+            problems += filter(None, kbundle.bundle.parallel_imap(check, present, jobs))
+
+    return len(present), problems
+
+def verify_archives(paths, jobs=None, quiet=False):
+    """Verify several bundle archives one after another, printing the results.
+
+    Returns True if every archive is intact.
+    """
+    failed = 0
+    for path in paths:
+        checked, problems = verify_archive(path, jobs)
+        for kind, name, detail in problems:
+            print("{}: {}: {} ({})".format(path, kind, name, detail))
+
+        if problems:
+            failed += 1
+            print("{}: FAILED, {} problems in {} members".format(path, len(problems), checked))
+        elif not quiet:
+            print("{}: OK, {} members".format(path, checked))
+
+    if len(paths) > 1:
+        print("Verified {} archives, {} failed.".format(len(paths), failed))
+
+    return not failed
@@ -0,0 +1,285 @@
+# Copyright 2023 Quytelda Kahja
+#
+# This file is part of kbundle.
+#
+# kbundle is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# kbundle is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with kbundle. If not, see <https://www.gnu.org/licenses/>.
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import os.path
+import select
+import struct
+import sys
+import time
+
+import kbundle.bundle
+import kbundle.cache
+import kbundle.scan
+
+logger = logging.getLogger(__name__)
+
+# inotify(7) event masks
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF   = 0x00000800
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ONLYDIR     = 0x01000000
+IN_ISDIR       = 0x40000000
+
+# Events watched for in resource directories and the bundle root.
+RESOURCE_DIR_EVENTS = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+                       IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF |
+                       IN_ONLYDIR)
+ROOT_DIR_EVENTS = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+
+# struct inotify_event, excluding the variable length name.
+INOTIFY_EVENT = struct.Struct("iIII")
+
+class PollingWatcher:
+    """Detect changes to resource files by periodically rescanning.
+
+    This works everywhere, but costs a stat() call for every resource
+    file on each poll. Files matched by the IgnoreRules `ignore_rules`
+    are skipped.
+    """
+
+    def __init__(self, root, interval=0.5, ignore_rules=None):
+        self.root = root
+        self.interval = interval
+        self.ignore_rules = ignore_rules
+        self.snapshot = self.__scan()
+
+    def close(self):
+        pass
+
+    def wait(self, timeout=None):
+        """Wait for changes and return the set of changed internal paths.
+
+        If nothing changes within `timeout` seconds, an empty set is
+        returned. If `timeout` is None, wait indefinitely.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            delay = self.interval
+            if deadline is not None:
+                delay = min(delay, max(0, deadline - time.monotonic()))
+            time.sleep(delay)
+
+            snapshot = self.__scan()
+            changed = {ipath for ipath in snapshot.keys() | self.snapshot.keys()
+                       if snapshot.get(ipath) != self.snapshot.get(ipath)}
+            self.snapshot = snapshot
+
+            if changed or (deadline is not None and time.monotonic() >= deadline):
+                return changed
+
+    def __scan(self):
+        snapshot = {}
+        for ipath, st in kbundle.scan.scan_tree(self.root, kbundle.bundle.RESOURCE_DIR_NAMES,
+                                                self.ignore_rules):
+            if st is not None:
+                snapshot[ipath] = kbundle.cache.stat_key(st)
+
+        return snapshot
+
+class InotifyWatcher:
+    """Detect changes to resource files using Linux inotify(7).
+
+    Every directory in the resource directory trees is watched, as
+    well as the bundle root, so that resource directories can be
+    created or removed while watching.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.libc = load_libc()
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+        # Maps watch descriptors to internal directory paths.
+        self.watches = {}
+
+        self.__add_watch(os.curdir, ROOT_DIR_EVENTS)
+        for dirname in kbundle.bundle.RESOURCE_DIR_NAMES:
+            self.__add_tree(dirname)
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def wait(self, timeout=None):
+        """Wait for changes and return the set of changed internal paths.
+
+        Paths of directories stand for everything inside them. If
+        nothing changes within `timeout` seconds, an empty set is
+        returned. If `timeout` is None, wait indefinitely.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None
+            if deadline is not None:
+                remaining = max(0, deadline - time.monotonic())
+
+            readable, _, _ = select.select([self.fd], [], [], remaining)
+            if not readable:
+                return set()
+
+            # Events for files which aren't resources are ignored.
+            changed = self.__read_events()
+            if changed:
+                return changed
+
+    def __read_events(self):
+        changed = set()
+        buf = os.read(self.fd, 64 * 1024)
+        offset = 0
+        while offset < len(buf):
+            wd, mask, _, name_len = INOTIFY_EVENT.unpack_from(buf, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(buf[offset:offset + name_len].rstrip(b'\0'))
+            offset += name_len
+
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, so everything has to be rechecked.
+                changed.update(kbundle.bundle.RESOURCE_DIR_NAMES)
+                continue
+
+            dirpath = self.watches.get(wd)
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+
+            if dirpath is None or not name:
+                continue
+
+            ipath = os.path.normpath(os.path.join(dirpath, name))
+            if dirpath == os.curdir and ipath not in kbundle.bundle.RESOURCE_DIR_NAMES:
+                continue
+
+            if not kbundle.bundle.is_visible(name):
+                continue
+
+            # New directories need watches of their own. Anything
+            # created inside them before the watch was added is picked
+            # up because the whole directory is reported as changed.
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self.__add_tree(ipath)
+
+            changed.add(ipath)
+
+        return changed
+
+    def __add_tree(self, ipath):
+        xpath = os.path.join(self.root, ipath)
+        for current_dir, subdirs, _ in os.walk(xpath):
+            subdirs[:] = filter(kbundle.bundle.is_visible, subdirs)
+            self.__add_watch(os.path.relpath(current_dir, self.root), RESOURCE_DIR_EVENTS)
+
+    def __add_watch(self, ipath, mask):
+        xpath = os.path.join(self.root, ipath)
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(xpath), mask)
+        if wd >= 0:
+            self.watches[wd] = os.path.normpath(ipath)
+
+def load_libc():
+    """Load the C library and check that it provides inotify functions."""
+    if not sys.platform.startswith("linux"):
+        raise OSError("inotify is only available on Linux")
+
+    libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    if not hasattr(libc, "inotify_init1"):
+        raise OSError("The C library does not support inotify")
+
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+
+    return libc
+
+def create_watcher(root, poll=False, interval=0.5, ignore_rules=None):
+    """Create an inotify watcher if possible, or a polling watcher otherwise."""
+    if not poll:
+        try:
+            return InotifyWatcher(root)
+        except OSError as e:
+            logger.warning("Falling back to polling: %s", e)
+
+    return PollingWatcher(root, interval, ignore_rules)
+
+def watch(bundle, archive_path=None, debounce=0.3, poll=False, interval=0.5, jobs=None):
+    """Keep a bundle's manifest (and optionally archive) up to date.
+
+    Changes are collected until none have arrived for `debounce`
+    seconds, then only the affected manifest entries are updated. If
+    `archive_path` is given, the archive is then repacked
+    incrementally. Runs until interrupted.
+    """
+    watcher = create_watcher(bundle.root, poll, interval, bundle.ignore_rules)
+
+    def refresh(ipaths):
+        # The manifest may have been changed by another command (such
+        # as `kbundle tag`) since it was last saved here.
+        if manifest_stat() != saved_stat and bundle.manifest.exists():
+            bundle.manifest.load()
+
+        ok = bundle.update_entries(ipaths, jobs) if ipaths else bundle.update_manifest(jobs=jobs)
+        if ok and archive_path is not None:
+            base_path = archive_path if os.path.isfile(archive_path) else None
+            ok = bundle.pack(archive_path, base_path=base_path, jobs=jobs)
+
+        return ok
+
+    def manifest_stat():
+        try:
+            return kbundle.cache.stat_key(os.stat(bundle.manifest.path))
+        except FileNotFoundError:
+            return None
+
+    saved_stat = None
+    try:
+        refresh(None)
+        saved_stat = manifest_stat()
+        logger.info("Watching for changes in %s (press Ctrl+C to stop).", bundle.root)
+
+        changed = set()
+        while True:
+            # Keep collecting events until things settle down.
+            events = watcher.wait(debounce if changed else None)
+            if events:
+                changed |= events
+                continue
+
+            start = time.monotonic()
+            if refresh(changed):
+                logger.info("Updated %d changed paths in %.3fs.",
+                            len(changed), time.monotonic() - start)
+            else:
+                logger.error("Failed to update bundle.")
+
+            saved_stat = manifest_stat()
+            changed.clear()
+    except KeyboardInterrupt:
+        return True
+    finally:
+        watcher.close()